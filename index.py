@@ -0,0 +1,203 @@
+# Siggi - Feature Hashing for Labeled Graphs
+# (c) 2015, 2017 Konrad Rieck (konrad@mlsec.org)
+
+import json
+import os
+
+import numpy as np
+import scipy.sparse as sp
+
+# Prime for universal hashing of dimensions in MinHash
+_prime = np.int64(2147483647)
+
+# Arrays stored in an index directory
+_arrays = [
+    "rows_indptr", "rows_indices", "rows_data", "cols_indptr", "cols_indices",
+    "cols_data", "norms", "labels", "hash_a", "hash_b", "band_keys",
+    "band_docs", "band_mult"
+]
+
+
+class Index(object):
+    """ Similarity search over hashed feature vectors. An inverted index
+        over the dimensions supports exact top-k queries, while a MinHash
+        signature with locality-sensitive hashing of bands supports fast
+        approximate queries. All arrays are stored as separate numpy
+        files and can be memory-mapped. """
+
+    def __init__(self, arrays, meta):
+        self.meta = meta
+        for name in _arrays:
+            setattr(self, name, arrays[name])
+
+    @classmethod
+    def build(cls, matrix, labels, perms=64, bands=16, seed=0, meta=None):
+        """ Build index from sparse matrix of feature vectors """
+
+        if perms % bands != 0:
+            raise Exception("Number of permutations not divisible by bands")
+
+        matrix = sp.csr_matrix(matrix, dtype=np.float64)
+        matrix.eliminate_zeros()
+        matrix.sort_indices()
+        cols = matrix.tocsc()
+        cols.sort_indices()
+
+        arrays = {
+            "rows_indptr": matrix.indptr.astype(np.int64),
+            "rows_indices": matrix.indices.astype(np.int64),
+            "rows_data": matrix.data,
+            "cols_indptr": cols.indptr.astype(np.int64),
+            "cols_indices": cols.indices.astype(np.int64),
+            "cols_data": cols.data,
+            "norms": np.sqrt(np.asarray(matrix.multiply(matrix).sum(1))
+                             .ravel()),
+            "labels": np.array(labels, dtype=np.int64),
+        }
+
+        # Random universal hash functions and band multipliers
+        rng = np.random.RandomState(seed)
+        arrays["hash_a"] = rng.randint(1, _prime, perms).astype(np.int64)
+        arrays["hash_b"] = rng.randint(0, _prime, perms).astype(np.int64)
+        mult = rng.randint(1, 2 ** 62, perms // bands).astype(np.uint64)
+        arrays["band_mult"] = mult | np.uint64(1)
+
+        meta = dict(meta or {})
+        meta.update({"shape": list(matrix.shape), "perms": perms,
+                     "bands": bands})
+        index = cls(dict(arrays, band_keys=None, band_docs=None), meta)
+
+        # Hash signatures of all vectors into buckets of each band
+        keys = np.zeros((bands, matrix.shape[0]), dtype=np.uint64)
+        for i in range(matrix.shape[0]):
+            row = slice(matrix.indptr[i], matrix.indptr[i + 1])
+            keys[:, i] = index.band_hashes(matrix.indices[row])
+
+        docs = np.argsort(keys, axis=1, kind="mergesort")
+        index.band_keys = keys[np.arange(bands)[:, None], docs]
+        index.band_docs = docs.astype(np.int64)
+
+        return index
+
+    @classmethod
+    def load(cls, path, mmap=True):
+        """ Load index from directory, memory-mapping its arrays """
+
+        mode = "r" if mmap else None
+        arrays = {}
+        for name in _arrays:
+            filename = os.path.join(path, name + ".npy")
+            arrays[name] = np.load(filename, mmap_mode=mode)
+
+        with open(os.path.join(path, "meta.json")) as f:
+            meta = json.load(f)
+
+        return cls(arrays, meta)
+
+    def save(self, path):
+        """ Save index to directory """
+
+        if not os.path.exists(path):
+            os.makedirs(path)
+        for name in _arrays:
+            np.save(os.path.join(path, name + ".npy"), getattr(self, name))
+
+        with open(os.path.join(path, "meta.json"), "w") as f:
+            json.dump(self.meta, f, indent=2, sort_keys=True)
+
+    def __len__(self):
+        return len(self.labels)
+
+    def frequencies(self):
+        """ Return number of vectors with non-zero value per dimension """
+        return np.diff(self.cols_indptr)
+
+    def signature(self, dims):
+        """ Compute MinHash signature of set of dimensions """
+
+        dims = np.asarray(dims, dtype=np.int64) % _prime
+        if len(dims) == 0:
+            return np.full(len(self.hash_a), _prime, dtype=np.int64)
+
+        hashes = (self.hash_a[:, None] * dims[None, :] +
+                  self.hash_b[:, None]) % _prime
+        return hashes.min(axis=1)
+
+    def band_hashes(self, dims):
+        """ Compute hash of each band of the MinHash signature """
+
+        bands = self.meta["bands"]
+        sig = self.signature(dims).astype(np.uint64).reshape(bands, -1)
+        with np.errstate(over="ignore"):
+            return (sig * np.asarray(self.band_mult)).sum(axis=1)
+
+    def candidates(self, dims):
+        """ Return vectors sharing at least one band with the query """
+
+        found = []
+        for band, key in enumerate(self.band_hashes(dims)):
+            keys = self.band_keys[band]
+            lo = np.searchsorted(keys, key, side="left")
+            hi = np.searchsorted(keys, key, side="right")
+            found.append(np.asarray(self.band_docs[band, lo:hi]))
+
+        return np.unique(np.concatenate(found))
+
+    def scores(self, dims, vals, rows=None):
+        """ Compute dot products of query with all or selected vectors """
+
+        n = len(self)
+        if rows is None:
+            # Accumulate products along the postings of each dimension
+            scores = np.zeros(n)
+            size = len(self.cols_indptr) - 1
+            for dim, val in zip(dims, vals):
+                if dim >= size:
+                    continue
+                post = slice(self.cols_indptr[dim], self.cols_indptr[dim + 1])
+                scores[self.cols_indices[post]] += val * self.cols_data[post]
+            return scores
+
+        # Match dimensions of each row against the sorted query
+        dims = np.asarray(dims, dtype=np.int64)
+        scores = np.zeros(len(rows))
+        if len(dims) == 0:
+            return scores
+        for k, i in enumerate(rows):
+            row = slice(self.rows_indptr[i], self.rows_indptr[i + 1])
+            pos = np.searchsorted(dims, self.rows_indices[row])
+            pos[pos == len(dims)] = 0
+            match = dims[pos] == self.rows_indices[row]
+            scores[k] = np.dot(self.rows_data[row][match], vals[pos[match]])
+        return scores
+
+    def query(self, fvec, k=10, metric="cosine", approx=False):
+        """ Return list of (row, label, score) of the k nearest vectors """
+
+        items = sorted((d, v) for d, v in fvec.items() if v != 0)
+        dims = [d for d, _ in items]
+        vals = np.array([v for _, v in items], dtype=np.float64)
+
+        if approx:
+            rows = self.candidates(dims)
+            scores = self.scores(dims, vals, rows)
+        else:
+            rows = np.arange(len(self))
+            scores = self.scores(dims, vals)
+
+        if metric == "cosine":
+            norms = np.asarray(self.norms)[rows] * np.sqrt(np.dot(vals, vals))
+            norms[norms == 0] = 1.0
+            scores = scores / norms
+        elif metric != "dot":
+            raise Exception("Unknown metric '%s'" % metric)
+
+        # Select top-k without sorting all scores
+        k = min(k, len(rows))
+        if k == 0:
+            return []
+        top = np.argpartition(-scores, k - 1)[:k]
+        top = top[np.argsort(-scores[top], kind="mergesort")]
+
+        return [(int(rows[i]), int(self.labels[rows[i]]), float(scores[i]))
+                for i in top]
@@ -0,0 +1,113 @@
+# Siggi - Feature Hashing for Labeled Graphs
+# (c) 2015, 2017 Konrad Rieck (konrad@mlsec.org)
+
+from multiprocessing import Pool
+
+import numpy as np
+import scipy.sparse as sp
+
+# Supported kernel functions
+kernels = ["linear", "cosine", "rbf"]
+
+# Data shared with the workers of the pool
+_shared = {}
+
+
+def _init(xs, ys, filename, kind, gamma):
+    """ Initialize worker with matrices and output file """
+
+    _shared.update({
+        "xs": xs, "ys": ys, "kind": kind, "gamma": gamma,
+        "xn": sq_norms(xs), "yn": sq_norms(ys),
+        "out": np.load(filename, mmap_mode="r+")
+    })
+
+
+def sq_norms(matrix):
+    """ Return squared norms of rows of sparse matrix """
+    return np.asarray(matrix.multiply(matrix).sum(axis=1)).ravel()
+
+
+def gram_block(xs, ys, kind="linear", gamma=1.0, xn=None, yn=None):
+    """ Compute kernel matrix between rows of two sparse matrices. The
+        squared norms of the rows can be passed to avoid recomputing
+        them for each block. """
+
+    block = (xs * ys.T).toarray()
+    if kind == "linear":
+        return block
+
+    xn = sq_norms(xs) if xn is None else xn
+    yn = sq_norms(ys) if yn is None else yn
+
+    if kind == "cosine":
+        norms = np.sqrt(np.outer(xn, yn))
+        norms[norms == 0] = 1.0
+        return block / norms
+    elif kind == "rbf":
+        dists = xn[:, None] + yn[None, :] - 2 * block
+        return np.exp(-gamma * np.maximum(dists, 0))
+    else:
+        raise Exception("Unknown kernel '%s'" % kind)
+
+
+def _compute(task):
+    """ Compute one block of the kernel matrix and write it to file """
+    i0, i1, j0, j1, mirror = task
+
+    xs, ys, out = _shared["xs"], _shared["ys"], _shared["out"]
+    block = gram_block(xs[i0:i1], ys[j0:j1], _shared["kind"],
+                       _shared["gamma"], _shared["xn"][i0:i1],
+                       _shared["yn"][j0:j1])
+
+    out[i0:i1, j0:j1] = block
+    if mirror:
+        out[j0:j1, i0:i1] = block.T
+    out.flush()
+
+    return (i1 - i0) * (j1 - j0) * (2 if mirror else 1)
+
+
+def compute_gram(filename, xs, ys=None, kind="linear", gamma=1.0,
+                 block=1024, processes=None, dtype=np.float32,
+                 callback=None):
+    """ Compute kernel matrix between rows of xs and ys (or xs itself)
+        in blocks using a pool of workers. The matrix is written to a
+        memory-mapped npy file and never held in memory completely. The
+        callback is called with the fraction of finished entries. """
+
+    if kind not in kernels:
+        raise Exception("Unknown kernel '%s'" % kind)
+
+    symmetric = ys is None
+    xs = sp.csr_matrix(xs, dtype=np.float64)
+    ys = xs if symmetric else sp.csr_matrix(ys, dtype=np.float64)
+    if xs.shape[1] != ys.shape[1]:
+        dim = max(xs.shape[1], ys.shape[1])
+        xs = sp.csr_matrix((xs.data, xs.indices, xs.indptr),
+                           shape=(xs.shape[0], dim))
+        ys = sp.csr_matrix((ys.data, ys.indices, ys.indptr),
+                           shape=(ys.shape[0], dim))
+
+    # Create output file before forking the workers
+    shape = (xs.shape[0], ys.shape[0])
+    out = np.lib.format.open_memmap(filename, "w+", dtype, shape)
+    del out
+
+    # Symmetric matrices only need blocks above the diagonal
+    tasks = []
+    for i0 in range(0, shape[0], block):
+        for j0 in range(i0 if symmetric else 0, shape[1], block):
+            i1, j1 = min(i0 + block, shape[0]), min(j0 + block, shape[1])
+            tasks.append((i0, i1, j0, j1, symmetric and i0 != j0))
+
+    pool = Pool(processes, _init, (xs, ys, filename, kind, gamma))
+    done = 0
+    for count in pool.imap_unordered(_compute, tasks):
+        done += count
+        if callback:
+            callback(float(done) / (shape[0] * shape[1]))
+    pool.close()
+    pool.join()
+
+    return np.load(filename, mmap_mode="r")
@@ -0,0 +1,426 @@
+# Siggi - Feature Hashing for Labeled Graphs
+# (c) 2015, 2017 Konrad Rieck (konrad@mlsec.org)
+
+import collections
+import hashlib
+import os
+import re
+import tempfile
+import threading
+import zipfile as zf
+import Queue
+from functools import partial
+from multiprocessing import cpu_count
+
+import siggi
+import utils
+
+# Marker for the end of the input
+_done = object()
+
+# Supported deduplication of graphs
+dedups = ["none", "content", "structure"]
+
+# Approximate memory per node or edge of a graph, per bag entry and per
+# node for the temporary structures of each mode, e.g., the paths of one
+# source in mode 4 or the blocks of the traversal in modes 2 and 3
+_graph_cost = 1536
+_bag_cost = 96
+_mode_cost = {0: 0, 1: 0, 2: 2048, 3: 2048, 4: 512, 5: 256, 6: 256, 7: 256}
+
+# Minimum size of a node or edge in the input, e.g. "a->b;" in DOT
+_entry_size = 8
+
+
+def peak_memory(reset=False):
+    """ Return peak resident memory of the process in bytes and reset it
+        if requested. Returns None if not supported (Linux only). """
+
+    try:
+        if reset:
+            with open("/proc/self/clear_refs", "w") as f:
+                f.write("5")
+        with open("/proc/self/status") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) * 1024
+    except IOError:
+        pass
+    return None
+
+
+def process_entry(item, mode, conf, measure=False):
+    """ Parse raw zip entry and map it to a feature vector. Returns the
+        vector, the feature map and, if requested, the memory used per
+        byte of the entry. The memory is measured as the increase of the
+        peak resident memory, but at least estimated from the size of
+        the graph and the bag, as freed memory is reused. """
+    data, format = item
+    start = peak_memory(reset=True) if measure else None
+
+    graph = utils.parse_graph(data, format)
+    nodes = graph.number_of_nodes()
+    size = nodes + graph.number_of_edges()
+    bag = getattr(siggi, siggi.modes[mode])(graph, conf)
+    del graph
+
+    fvec, fmap = siggi.bag_to_fvec(bag, conf)
+    if not measure:
+        return fvec, fmap, None
+
+    cost = len(data) + _graph_cost * size + _mode_cost[mode] * nodes + \
+        sum(_bag_cost + len(key) for key in bag)
+    if start is not None:
+        cost = max(cost, peak_memory() - start)
+    return fvec, fmap, float(cost) / max(1, len(data))
+
+
+class Budget(object):
+    """ Bound the estimated memory of entries in flight. The memory of an
+        entry is predicted from its uncompressed size and the largest
+        ratio of memory to size observed for recent entries. As the
+        initial ratio may be too low, entries are processed alone until
+        a ratio has been observed. An entry exceeding the whole budget
+        is processed alone as well. """
+
+    def __init__(self, limit, ratio=64.0, window=256):
+        self.limit = limit
+        self.ratio = ratio
+        self.used = 0
+        self.peak = 0
+        self.recent = collections.deque(maxlen=window)
+        self.cond = threading.Condition()
+
+    def acquire(self, size):
+        """ Block until an entry of given size fits and return its cost """
+
+        with self.cond:
+            # The ratio may change while waiting
+            cost = max(1, int(size * self.ratio))
+            while self.used > 0 and \
+                    (not self.recent or self.used + cost > self.limit):
+                self.cond.wait()
+                cost = max(1, int(size * self.ratio))
+            self.used += cost
+            self.peak = max(self.peak, self.used)
+            return cost
+
+    def release(self, cost, ratio=None):
+        """ Release cost of an entry and record its observed ratio """
+
+        with self.cond:
+            self.used -= cost
+            if ratio is not None:
+                self.recent.append(ratio)
+                self.ratio = max(self.recent)
+            self.cond.notify_all()
+
+    def close(self):
+        """ Admit all waiting entries, e.g., after a failure """
+
+        with self.cond:
+            self.limit = float("inf")
+            self.cond.notify_all()
+
+
+class Pipeline(object):
+    """ Overlap reading, extraction and writing of graph bundles.
+
+        A reader thread loads raw entries from the zip archives, the
+        worker pool of the hasher parses and hashes the graphs and the
+        calling thread normalizes blocks of vectors and writes them in
+        input order. The number of entries in flight is bounded to limit
+        memory usage. Optionally, their estimated memory is bounded by a
+        budget in bytes.
+
+        Duplicate graphs can be skipped, either by the digest of their
+        content or by their labeled structure up to isomorphism. Only the
+        first occurrence is extracted and its vector is written for each
+        duplicate. The vectors of the most recent distinct graphs are
+        kept for this purpose. Comparing structures requires parsing each
+        distinct graph in the reader thread, which pays off only for
+        expensive modes. """
+
+    def __init__(self, hasher, regex="^\d+", depth=None, chunksize=4,
+                 block=1024, dedup="none", memory=0, cache=4096):
+        if dedup not in dedups:
+            raise Exception("Unknown deduplication '%s'" % dedup)
+
+        self.hasher = hasher
+        self.dedup = dedup
+        self.cache = cache
+        self.block = block
+        self.regex = re.compile(regex)
+        if not depth:
+            workers = hasher.processes
+            if workers is None:
+                workers = cpu_count()
+            depth = 8 * chunksize * max(1, workers)
+
+        # The pool needs a full chunk in flight before dispatching it,
+        # which a budget could prevent from filling up
+        ratio = float(_graph_cost + _mode_cost[hasher.mode]) / _entry_size
+        self.budget = Budget(memory, ratio) if memory > 0 else None
+        self.chunksize = 1 if self.budget else min(chunksize, depth)
+        self.depth = depth
+        self.slots = threading.Semaphore(depth)
+        self.queue = Queue.Queue(maxsize=depth)
+        self.stopped = threading.Event()
+        self.error = None
+
+    def fingerprint(self, data, format, seen):
+        """ Return key of a graph for deduplication or None """
+
+        if self.dedup == "none":
+            return None
+
+        key = (format, hashlib.sha1(data).digest())
+        if self.dedup == "structure":
+            # Parse each distinct content only once
+            if key not in seen:
+                graph = utils.parse_graph(data, format)
+                seen[key] = self.structure(graph, seen)
+            key = seen[key]
+
+        return key
+
+    def structure(self, graph, seen):
+        """ Return id of an isomorphic graph seen before or a new id. The
+            Weisfeiler-Lehman hash selects candidates, which are confirmed
+            by an isomorphism test. """
+
+        conf = self.hasher.args
+        bucket = siggi.structure_hash(graph, conf)
+        graph = siggi.labeled_structure(graph, conf)
+
+        reps, buckets = seen["reps"], seen["buckets"]
+        for i in buckets.get(bucket, []):
+            if siggi.same_structure(reps[i][1], graph):
+                reps[i] = reps.pop(i)
+                return i
+
+        # Keep only the most recent distinct structures
+        i = seen["count"] = seen["count"] + 1
+        reps[i] = (bucket, graph)
+        buckets.setdefault(bucket, []).append(i)
+        if len(reps) > self.cache:
+            j, (old, _) = reps.popitem(last=False)
+            buckets[old].remove(j)
+            if not buckets[old]:
+                del buckets[old]
+
+        return i
+
+    def read(self, jobs):
+        """ Read entries of jobs (bundle, entries) into the queue """
+
+        seen = {"reps": collections.OrderedDict(), "buckets": {}, "count": 0}
+        try:
+            for job, (bundle, entries) in enumerate(jobs):
+                archive = zf.ZipFile(bundle)
+                for entry in entries:
+                    if self.stopped.is_set():
+                        break
+                    cost = 0
+                    if self.budget:
+                        size = archive.getinfo(entry).file_size
+                        cost = self.budget.acquire(size)
+
+                    data = archive.read(entry)
+                    label = utils.entry_label(entry, self.regex)
+                    format = utils.entry_format(entry)
+                    key = self.fingerprint(data, format, seen)
+                    self.queue.put((job, label, key, cost, (data, format)))
+                archive.close()
+        except Exception as e:
+            self.error = e
+        finally:
+            self.queue.put(_done)
+
+    def stop(self, reader):
+        """ Stop the reader thread after a failure """
+
+        self.stopped.set()
+        if self.budget:
+            self.budget.close()
+        while reader.is_alive():
+            try:
+                self.queue.get(timeout=0.1)
+            except Queue.Empty:
+                pass
+
+        # Let the task feeder of the pool finish as well
+        try:
+            self.queue.put_nowait(_done)
+        except Queue.Full:
+            pass
+        self.slots.release()
+
+    def items(self, meta):
+        """ Yield items for the workers and record their labels. Entries
+            with a key seen before are recorded but not yielded. """
+
+        keys = collections.OrderedDict()
+        while True:
+            # Block until a result has been written
+            self.slots.acquire()
+            if self.stopped.is_set():
+                return
+            item = self.queue.get()
+            if item is _done:
+                return
+
+            job, label, key, cost, payload = item
+            dup = key is not None and key in keys
+            evict = None
+            if dup:
+                keys[key] = keys.pop(key)
+            elif key is not None:
+                # The writer drops the vector when reaching this entry
+                keys[key] = True
+                if len(keys) > self.cache:
+                    evict = keys.popitem(last=False)[0]
+
+            meta.append((job, label, key, dup, cost, evict))
+            if dup:
+                self.release(cost)
+                continue
+            yield payload
+
+    def release(self, cost, ratio=None):
+        """ Release slot and budget of an entry """
+        if self.budget:
+            self.budget.release(cost, ratio)
+        self.slots.release()
+
+    def flush(self, f, fvecs, labels, weighting=None):
+        """ Normalize block of feature vectors and write them """
+
+        conf = self.hasher.args
+        matrix = utils.fvecs_to_csr(fvecs, self.hasher.dim())
+        matrix = siggi.matrix_map(matrix, conf)
+
+        # Keep full precision for the second pass of the weighting
+        if weighting:
+            weighting.update(matrix)
+            utils.write_libsvm_csr(f, matrix, labels, "%.17g")
+        else:
+            matrix = siggi.matrix_norm(matrix, conf)
+            utils.write_libsvm_csr(f, matrix, labels)
+
+    def reweight(self, filename, output, weighting):
+        """ Apply corpus weighting to vectors in a second pass """
+
+        conf = self.hasher.args
+        f = open(output, "w")
+        for matrix, labels in utils.iter_libsvm(filename, self.block,
+                                                self.hasher.dim()):
+            matrix = weighting.transform(matrix)
+            matrix = siggi.matrix_norm(matrix, conf)
+            utils.write_libsvm_csr(f, matrix, labels)
+        f.close()
+
+    def run(self, jobs, output, callback=None):
+        """ Process jobs and write vectors to libsvm output. The callback
+            is called with the job index when a job starts writing. If
+            processing fails, no partial output is left behind. """
+
+        # Corpus weighting requires a first pass over all vectors
+        weighting = None
+        if self.hasher.args.weight.lower() != "none":
+            weighting = siggi.Weighting(self.hasher.args.weight,
+                                        self.hasher.dim())
+            outdir = os.path.dirname(os.path.abspath(output))
+            fd, first = tempfile.mkstemp(suffix=".libsvm", dir=outdir)
+            f = os.fdopen(fd, "w")
+        else:
+            first = output
+            f = open(output, "w")
+
+        try:
+            total, fmaps = self.write(jobs, f, weighting, callback)
+            f.close()
+            if weighting:
+                self.reweight(first, output, weighting)
+        except:
+            f.close()
+            if os.path.exists(output):
+                os.unlink(output)
+            raise
+        finally:
+            if weighting and os.path.exists(first):
+                os.unlink(first)
+
+        return total, fmaps
+
+    def write(self, jobs, f, weighting=None, callback=None):
+        """ Process jobs and write vectors to file in input order """
+
+        self.hasher.start()
+        reader = threading.Thread(target=self.read, args=(jobs,))
+        reader.daemon = True
+        reader.start()
+
+        try:
+            count, fmaps = self.collect(f, weighting, callback)
+        except:
+            self.stop(reader)
+            raise
+
+        reader.join()
+        if self.error:
+            raise self.error
+
+        return count, fmaps
+
+    def collect(self, f, weighting=None, callback=None):
+        """ Collect results of the workers and write them in blocks """
+
+        # Labels are recorded by the task feeder before results return
+        meta = []
+        func = partial(process_entry, mode=self.hasher.mode,
+                       conf=self.hasher.args, measure=bool(self.budget))
+        results = self.hasher.imap(func, self.items(meta), self.chunksize)
+
+        fmaps = []
+        fvecs, labels = [], []
+        self.hits = 0
+        state = {"pos": 0, "job": None}
+        cache = {}
+
+        def emit(fvec):
+            job, label = meta[state["pos"]][:2]
+            state["pos"] += 1
+            if job != state["job"] and callback:
+                callback(job)
+            state["job"] = job
+
+            fvecs.append(fvec)
+            labels.append(label)
+            if len(fvecs) == self.block:
+                self.flush(f, fvecs, labels, weighting)
+                del fvecs[:], labels[:]
+
+        def emit_duplicates():
+            # Duplicates follow the first occurrence in the input
+            while state["pos"] < len(meta) and meta[state["pos"]][3]:
+                self.hits += 1
+                emit(cache[meta[state["pos"]][2]])
+
+        for fvec, fmap, ratio in results:
+            emit_duplicates()
+            _, _, key, _, cost, evict = meta[state["pos"]]
+            if key is not None:
+                cache[key] = fvec
+                cache.pop(evict, None)
+            emit(fvec)
+
+            if fmap is not None:
+                fmaps.append(fmap)
+            self.release(cost, ratio)
+
+        emit_duplicates()
+        if fvecs:
+            self.flush(f, fvecs, labels, weighting)
+
+        return len(meta), fmaps
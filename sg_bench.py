@@ -5,7 +5,6 @@
 import argparse
 import random
 import time
-from multiprocessing import Pool
 
 import siggi
 import utils
@@ -25,10 +24,8 @@ parser.add_argument('-r', '--ratio', metavar='R', default=1, type=float,
                     help='sample ratio to use for benchmark')
 siggi.add_arguments(parser)
 args = parser.parse_args()
-siggi.set_args(args)
-
-# Initialize pool for multi-threading
-pool = Pool()
+if args.weight.lower() != "none":
+    parser.error("corpus weighting is not supported in benchmark mode")
 
 # Loop over bundles on command line
 testset = []
@@ -42,22 +39,20 @@ for i, bundle in enumerate(args.bundle):
     testset.extend(graphs)
 
 if args.mode == -1:
-    modes = siggi.modes.items()
+    modes = sorted(siggi.modes)
 else:
-    modes = [(args.mode, siggi.modes[args.mode])]
+    modes = [args.mode]
 
 print("= Benchmarking modes for %g seconds" % args.time)
-for mode, fname in modes:
+for mode in modes:
+    hasher = siggi.Hasher.from_args(args, mode=mode, processes=0)
     times = []
     while sum(times) < args.time:
         start = time.time()
         graph = random.choice(testset)
 
         # Compute feature hashing
-        func = getattr(siggi, fname)
-        bag = func(graph)
-        fvec = siggi.bag_to_fvec(bag)
-        fvec = siggi.fvec_norm(fvec)
+        fvec = hasher.transform(graph)
 
         times.append(time.time() - start)
 
@@ -3,12 +3,27 @@
 # (c) 2015, 2017 Konrad Rieck (konrad@mlsec.org)
 
 import argparse
+import copy
+import math
+import os
+import pickle
+import shutil
+import tempfile
+import threading
 import unittest
+import zipfile
+from io import BytesIO
 
 import networkx as nx
+import numpy as np
 import pygraphviz as pg
 
+import index
+import kernel
+import pipeline
+import sg_serve
 import siggi
+import utils
 
 # Test cases in DOT format
 dot_strings = [
@@ -50,6 +65,15 @@ def get_graph(string):
     return nx.drawing.nx_agraph.from_agraph(dot)
 
 
+def get_graphml(string):
+    """ Convert a DOT string to GraphML data """
+    graph = get_graph(string)
+    graph.graph = {}
+    data = BytesIO()
+    nx.write_graphml(graph, data)
+    return data.getvalue()
+
+
 class TestCases(unittest.TestCase):
     def test_bag_of_nodes(self):
         bags = [
@@ -125,6 +149,33 @@ class TestCases(unittest.TestCase):
             bag = siggi.bag_of_reachabilities(graph)
             self.assertEqual(bag, bags[i])
 
+    def test_reachable_blocks(self):
+        # More than 64 sources need several blocks of the traversal
+        graph = nx.gnp_random_graph(150, 0.02, seed=1, directed=True)
+        graphs = [graph, graph.to_undirected(), nx.MultiDiGraph(graph)]
+        graphs[2].add_edges_from(graph.edges()[:50])
+        for x in graph.nodes():
+            for g in graphs:
+                g.node[x]["label"] = "ABC"[x % 3]
+
+        conf = copy.copy(siggi.args)
+        conf.size, conf.depth, conf.sample = 2, 2, 0
+        for g in graphs:
+            neighborhoods, reachabilities = {}, {}
+            paths = nx.all_pairs_shortest_path(g, cutoff=2)
+            for x in g.nodes():
+                ns = sorted("ABC"[y % 3] for y in paths[x] if y != x)
+                key = "%s:%s" % ("ABC"[x % 3], "-".join(ns))
+                neighborhoods[key] = neighborhoods.get(key, 0) + 1
+                for n in ns:
+                    key = "%s:%s" % ("ABC"[x % 3], n)
+                    reachabilities[key] = reachabilities.get(key, 0) + 1
+
+            self.assertEqual(siggi.bag_of_neighborhoods(g, conf),
+                             neighborhoods)
+            self.assertEqual(siggi.bag_of_reachabilities(g, conf),
+                             reachabilities)
+
     def test_bag_of_shortest_paths(self):
         bags = [
             {},  # Empty graph
@@ -150,6 +201,68 @@ class TestCases(unittest.TestCase):
             bag = siggi.bag_of_shortest_paths(graph)
             self.assertEqual(bag, bags[i])
 
+    def test_sampled_sources(self):
+        conf = copy.copy(siggi.args)
+        conf.depth, conf.minlen, conf.maxlen = 2, 2, 3
+        graph = get_graph(dot_strings[3])
+
+        funcs = [siggi.bag_of_reachabilities, siggi.bag_of_shortest_paths]
+        for func in funcs:
+            exact = func(graph, conf)
+
+            # Sampling all nodes yields the exact bag
+            conf.sample = len(graph)
+            self.assertEqual(func(graph, conf), exact)
+
+            # Sampling is reproducible and unbiased on average
+            conf.sample = 3
+            for strata in ["uniform", "degree"]:
+                conf.strata = strata
+                self.assertEqual(func(graph, conf), func(graph, conf))
+
+                total = 0.0
+                for seed in range(200):
+                    conf.seed = seed
+                    total += sum(func(graph, conf).values()) / 200
+                self.assertAlmostEqual(total / sum(exact.values()), 1.0,
+                                       delta=0.1)
+            conf.sample = 0
+
+        # Small strata, like the hub of a star, are always sampled
+        star = nx.DiGraph()
+        star.add_node(0, label="A")
+        for x in range(1, 101):
+            star.add_node(x, label="B")
+            star.add_edge(0, x)
+        conf.depth, conf.sample, conf.strata = 1, 10, "degree"
+        for seed in range(20):
+            conf.seed = seed
+            self.assertEqual(siggi.bag_of_reachabilities(star, conf),
+                             {"A:B": 100.0})
+
+        # Undirected graphs are stratified by degree
+        for seed in range(20):
+            conf.seed = seed
+            bag = siggi.bag_of_reachabilities(star.to_undirected(), conf)
+            self.assertEqual(sorted(bag), ["A:B", "B:A"])
+            self.assertEqual(bag["A:B"], 100.0)
+            self.assertAlmostEqual(bag["B:A"], 100.0)
+
+        # With fewer sources than strata, all nodes are equally likely
+        for x in range(1, 11):
+            for y in range(x + 1, 2 ** (x % 5) + x + 1):
+                star.add_edge(x, y)
+        conf.sample = 3
+        counts = [0] * len(star)
+        for seed in range(1000):
+            conf.seed = seed
+            sources, weights = siggi.sample_sources(star, star.nodes(), conf)
+            self.assertEqual(set(weights), set([len(star) / 3.0]))
+            for i in sources:
+                counts[i] += 1
+        self.assertAlmostEqual(counts[0] / 1000.0, 3.0 / len(star),
+                               delta=0.02)
+
     def test_bag_of_connected_components(self):
         bags = [
             {},  # Empty graph
@@ -203,8 +316,389 @@ class TestCases(unittest.TestCase):
 
         for i, string in enumerate(dot_strings):
             graph = get_graph(string)
+            size = len(graph)
             bag = siggi.bag_of_branchless_paths(graph)
             self.assertEqual(bag, bags[i])
+            self.assertEqual(len(graph), size)
+
+    def test_structure_hash(self):
+        g1 = get_graph(dot_strings[3])
+        h1 = siggi.structure_hash(g1)
+
+        # Renamed nodes and additional attributes do not matter
+        g2 = nx.relabel_nodes(g1, {x: "n" + x for x in g1.nodes()})
+        g2.node["n1"]["color"] = "red"
+        self.assertEqual(siggi.structure_hash(g2), h1)
+
+        g2.add_edge("n6", "n1")
+        self.assertNotEqual(siggi.structure_hash(g2), h1)
+        g2 = get_graph(dot_strings[3].replace('4 [label="A"]',
+                                              '4 [label="B"]'))
+        self.assertNotEqual(siggi.structure_hash(g2), h1)
+
+    def test_budget(self):
+        self.assertEqual(utils.parse_size("2M"), 2 * 1024 ** 2)
+        self.assertEqual(utils.parse_size("1.5k"), 1536)
+
+        budget = pipeline.Budget(1000, ratio=1.0)
+        self.assertEqual(budget.acquire(50), 50)
+
+        # The initial ratio underestimates the memory, so entries are
+        # processed alone until a ratio has been observed
+        costs = []
+        thread = threading.Thread(
+            target=lambda: costs.append(budget.acquire(40))
+        )
+        thread.start()
+        thread.join(0.2)
+        self.assertTrue(thread.is_alive())
+        budget.release(50, 10.0)
+        thread.join()
+        self.assertEqual(costs, [400])
+
+        self.assertEqual(budget.acquire(50), 500)
+        self.assertEqual(budget.peak, 900)
+        budget.release(400, 2.0)
+        budget.release(500, 4.0)
+        self.assertEqual(budget.ratio, 10.0)
+
+        # Entries exceeding the budget pass if nothing is in flight
+        self.assertEqual(budget.acquire(1000), 10000)
+        self.assertEqual(budget.peak, 10000)
+
+        # Paths of mode 4 need more memory than the graph itself
+        graph = nx.path_graph(100, nx.DiGraph())
+        for node in graph.nodes():
+            graph.node[node]["label"] = str(node % 3)
+        data = BytesIO()
+        nx.write_graphml(graph, data)
+        entry, conf = (data.getvalue(), "graphml"), siggi.Hasher().args
+        _, _, ratio0 = pipeline.process_entry(entry, 0, conf, measure=True)
+        _, _, ratio4 = pipeline.process_entry(entry, 4, conf, measure=True)
+        self.assertIsNone(pipeline.process_entry(entry, 0, conf)[2])
+        self.assertGreater(ratio0, 1.0)
+        self.assertGreater(ratio4, ratio0)
+
+    def test_bag_state(self):
+        for mode in range(5):
+            g = get_graph(dot_strings[3])
+            hasher = siggi.Hasher(mode=mode, size=2, depth=2, minlen=0)
+            state = hasher.state(g)
+            self.assertEqual(state.bag, hasher.bag(g))
+
+            state.update(add_nodes={"7": {"label": "C"}},
+                         add_edges=[("6", "7"), ("7", "1")],
+                         remove_edges=[("5", "2")],
+                         labels={"3": {"label": "A"}})
+            state.update(remove_nodes=["4"])
+
+            bag = hasher.bag(g)
+            self.assertEqual(state.bag, {k: v for k, v in bag.items() if v})
+            fvec, _ = siggi.bag_to_fvec(bag, hasher.args)
+            self.assertEqual(state.fvec(), {k: v for k, v in fvec.items()
+                                            if v})
+
+        # Undirected edges are reached from both of their nodes
+        for mode in [0, 2, 3, 4]:
+            g = get_graph(dot_strings[3]).to_undirected()
+            hasher = siggi.Hasher(mode=mode, size=2, depth=2, minlen=0)
+            state = hasher.state(g)
+            state.update(add_edges=[("1", "6")], remove_edges=[("3", "2")])
+            state.update(remove_nodes=["5"], labels={"4": {"label": "C"}})
+            self.assertEqual(state.bag, hasher.bag(g))
+
+        g = nx.Graph()
+        g.add_nodes_from([(0, {"label": "A"}), (1, {"label": "B"}),
+                          (2, {"label": "C"})])
+        g.add_edge(0, 1)
+        hasher = siggi.Hasher(mode=3, depth=1)
+        state = hasher.state(g)
+        state.update(add_edges=[(2, 1)])
+        self.assertIn("B:C", state.bag)
+        self.assertEqual(state.bag, hasher.bag(g))
+
+    def test_batcher(self):
+        graph = get_graph(dot_strings[3])
+        data = get_graphml(dot_strings[3])
+
+        hasher = siggi.Hasher(mode=1, processes=0)
+        stats = sg_serve.Stats()
+        batcher = sg_serve.Batcher(hasher, 4, 1.0, stats)
+        batcher.start()
+
+        fvec, error = batcher.submit(data, "graphml")
+        self.assertEqual(error, None)
+        self.assertEqual(fvec, hasher.transform(graph))
+        fvec, error = batcher.submit("<graphml", "graphml")
+        self.assertEqual(fvec, None)
+        self.assertTrue(error)
+
+        # A failing batch returns errors and the batcher keeps running
+        hasher.map = lambda func, items: 1 / 0
+        fvec, error = batcher.submit(data, "graphml")
+        self.assertTrue(error.startswith("ZeroDivisionError"))
+        del hasher.map
+        fvec, error = batcher.submit(data, "graphml")
+        self.assertEqual(error, None)
+
+        stats.add_request(0.002)
+        stats.add_request(0.004, error=True)
+        report = stats.report()
+        self.assertEqual(report["graphs"], 4)
+        self.assertEqual(report["batches"], 4)
+        self.assertEqual(report["errors"], 1)
+        self.assertAlmostEqual(report["latency_mean"], 3.0)
+
+    def test_pipeline(self):
+        path = tempfile.mkdtemp()
+        try:
+            # Bundles of graphs with labels in the entry names
+            bundles, expected = [], []
+            for k in range(2):
+                bundles.append(os.path.join(path, "bundle%d.zip" % k))
+                archive = zipfile.ZipFile(bundles[-1], "w")
+                for i, string in enumerate(dot_strings[1:] * 2):
+                    data = get_graphml(string)
+                    archive.writestr("%d_%d.graphml" % (k + i, i), data)
+                    expected.append((k + i, utils.parse_graph(data,
+                                                              "graphml")))
+                archive.close()
+
+            jobs = []
+            for bundle in bundles:
+                entries = utils.list_bundle(bundle)
+                jobs.extend((bundle, c)
+                            for c in utils.chunkify_entries(entries, 3))
+
+            output = os.path.join(path, "output.libsvm")
+            for processes, depth in [(0, None), (2, 1), (2, None)]:
+                hasher = siggi.Hasher(mode=2, processes=processes)
+                pipe = pipeline.Pipeline(hasher, depth=depth, block=3)
+                started = []
+                count, _ = pipe.run(jobs, output, started.append)
+                hasher.close()
+
+                self.assertEqual(count, len(expected))
+                self.assertEqual(started, list(range(len(jobs))))
+                fvecs, labels = utils.load_libsvm(output)
+                self.assertEqual(labels, [l for l, _ in expected])
+                for fvec, (_, graph) in zip(fvecs, expected):
+                    ref = hasher.transform(graph)
+                    self.assertEqual(sorted(fvec), sorted(ref))
+                    for dim in fvec:
+                        self.assertAlmostEqual(fvec[dim], ref[dim], 5)
+
+            # Duplicates are written at their positions in the input
+            graph = get_graph(dot_strings[3])
+            renamed = nx.relabel_nodes(graph, {x: "n" + x for x in graph})
+            cycle = nx.DiGraph([(i, (i + 1) % 6) for i in range(6)])
+            cycles = nx.DiGraph([(i, (i + 1) % 3 + 3 * (i / 3))
+                                 for i in range(6)])
+            for g in [cycle, cycles]:
+                for x in g:
+                    g.node[x]["label"] = "A"
+
+            dups = os.path.join(path, "dups.zip")
+            archive = zipfile.ZipFile(dups, "w")
+            for i, g in enumerate([graph, graph, renamed, cycle, cycles,
+                                   graph, get_graph(dot_strings[2]),
+                                   cycle]):
+                data = BytesIO()
+                g.graph = {}
+                nx.write_graphml(g, data)
+                archive.writestr("%d_%d.graphml" % (i, i), data.getvalue())
+            archive.close()
+
+            jobs = [(dups, utils.list_bundle(dups))]
+            for mode in [4, 5]:
+                hasher = siggi.Hasher(mode=mode, minlen=3, maxlen=3,
+                                      processes=2)
+                pipeline.Pipeline(hasher).run(jobs, output)
+                expected = open(output).read()
+                for dedup, cache, hits in [("content", 4096, 3),
+                                           ("structure", 4096, 4),
+                                           ("structure", 1, 2)]:
+                    pipe = pipeline.Pipeline(hasher, dedup=dedup,
+                                             cache=cache)
+                    pipe.run(jobs, output)
+                    self.assertEqual(open(output).read(), expected)
+                    self.assertEqual(pipe.hits, hits)
+                hasher.close()
+            os.unlink(dups)
+
+            # Failing reader or worker leaves no partial output
+            bad = os.path.join(path, "bad.zip")
+            archive = zipfile.ZipFile(bad, "w")
+            archive.writestr("1_0.graphml", get_graphml(dot_strings[1]))
+            archive.writestr("1_1.graphml", "<graphml")
+            archive.close()
+            missing = os.path.join(path, "missing.zip")
+
+            os.unlink(output)
+            files = sorted(os.listdir(path))
+            for weight in ["none", "idf"]:
+                for failed in [[(bad, utils.list_bundle(bad))] * 3,
+                               [jobs[0], (missing, ["1_0.graphml"])]]:
+                    hasher = siggi.Hasher(processes=2, weight=weight)
+                    pipe = pipeline.Pipeline(hasher, depth=2)
+                    self.assertRaises(Exception, pipe.run, failed, output)
+                    hasher.close()
+                    self.assertEqual(sorted(os.listdir(path)), files)
+        finally:
+            shutil.rmtree(path)
+
+    def test_hasher(self):
+        hasher = siggi.Hasher(mode=1, bits=8, norm="l2", processes=0)
+
+        graphs = [get_graph(string) for string in dot_strings]
+        matrix = hasher.transform_many(graphs)
+        self.assertEqual(matrix.shape, (len(graphs), 257))
+
+        for i, graph in enumerate(graphs):
+            fvec = hasher.transform(graph)
+            self.assertEqual(matrix[i].nnz, len(fvec))
+            for dim in fvec:
+                self.assertAlmostEqual(matrix[i, dim], fvec[dim])
+
+        # Global arguments are left untouched
+        self.assertNotEqual(siggi.args.bits, 8)
+
+        # Settings are stored next to the feature vectors
+        tmpdir = tempfile.mkdtemp()
+        try:
+            filename = os.path.join(tmpdir, "output.libsvm")
+            self.assertIsNone(utils.load_settings(filename))
+            utils.save_settings(filename, hasher.settings())
+            settings = utils.load_settings(filename)
+        finally:
+            shutil.rmtree(tmpdir)
+        other = siggi.Hasher.from_settings(settings, processes=0)
+        self.assertEqual(other.mode, 1)
+        self.assertEqual(other.settings(), hasher.settings())
+        self.assertEqual(other.dim(), 257)
+
+    def test_matrix_norm(self):
+        graphs = [get_graph(string) for string in dot_strings]
+        conf = copy.copy(siggi.args)
+
+        for mtype in ["binary", "count", "log"]:
+            for norm in ["none", "l1", "l2"]:
+                conf.map, conf.norm = mtype, norm
+                fvecs = [siggi.bag_to_fvec(siggi.bag_of_edges(g, conf),
+                                           conf)[0] for g in graphs]
+                matrix = utils.fvecs_to_csr(fvecs, (1 << conf.bits) + 1)
+                matrix = siggi.matrix_map(matrix, conf)
+                matrix = siggi.matrix_norm(matrix, conf)
+
+                for i, fvec in enumerate(fvecs):
+                    fvec = siggi.fvec_norm(fvec, conf)
+                    for dim in fvec:
+                        self.assertAlmostEqual(matrix[i, dim], fvec[dim])
+
+    def test_weighting(self):
+        matrix = utils.fvecs_to_csr([{1: 2.0, 2: 1.0}, {1: -1.0}], 4)
+
+        weighting = siggi.Weighting("idf", 4)
+        weighting.update(matrix)
+        result = weighting.transform(matrix.copy())
+        self.assertAlmostEqual(result[0, 1], 2.0)
+        self.assertAlmostEqual(result[0, 2], 1.0 + math.log(1.5))
+
+        weighting = siggi.Weighting("maxabs", 4)
+        weighting.update(matrix)
+        result = weighting.transform(matrix.copy())
+        self.assertAlmostEqual(result[0, 1], 1.0)
+        self.assertAlmostEqual(result[1, 1], -0.5)
+
+        # Single graphs are weighted like many graphs
+        graphs = [get_graph(x) for x in dot_strings[1:]]
+        hasher = siggi.Hasher(mode=1, weight="idf", processes=0)
+        self.assertRaises(Exception, hasher.transform, graphs[0])
+        matrix = hasher.transform_many(graphs, fit=True)
+        for i, graph in enumerate(graphs):
+            fvec = hasher.transform(graph)
+            self.assertEqual(sorted(fvec), list(matrix[i].indices))
+            for dim in fvec:
+                self.assertAlmostEqual(fvec[dim], matrix[i, dim])
+
+    def test_sparse_vector(self):
+        fvec = {3: 1.0, 1: -2.0, 7: 0.5}
+        svec = utils.SparseVector.from_dict(fvec)
+
+        self.assertEqual(svec, fvec)
+        self.assertEqual(list(svec), [1, 3, 7])
+        self.assertEqual(pickle.loads(pickle.dumps(svec, 2)), svec)
+        self.assertEqual(utils.format_libsvm(svec, 1),
+                         utils.format_libsvm(fvec, 1))
+
+        svec[5] = 2.0
+        self.assertEqual(svec.keys(), [1, 3, 5, 7])
+        self.assertTrue(5 in svec)
+        self.assertFalse(4 in svec)
+        self.assertRaises(KeyError, lambda: svec[4])
+
+        # Keys colliding in the hash table are not iterated sorted
+        other = {9: 9.0, 1: 1.0, 17: 17.0}
+        stacked = utils.stack_fvecs([svec], [other])[0]
+        expected = utils.stack_fvecs([dict(svec.items())], [other])[0]
+        self.assertEqual(stacked, expected)
+        self.assertEqual(list(stacked), sorted(expected))
+        for dim in expected:
+            self.assertEqual(stacked[dim], expected[dim])
+
+    def test_index(self):
+        fvecs = [{1: 1.0, 2: 1.0}, {2: 1.0, 3: 1.0}, {1: 2.0, 2: 2.0, 4: 1.0},
+                 {5: -1.0}]
+        matrix = utils.fvecs_to_csr(fvecs, 8)
+        idx = index.Index.build(matrix, [1, 2, 3, 4], perms=16, bands=8)
+
+        result = idx.query(fvecs[0], k=2)
+        self.assertEqual([row for row, _, _ in result], [0, 2])
+        self.assertAlmostEqual(result[0][2], 1.0)
+        self.assertEqual(idx.query(fvecs[3], k=1, metric="dot")[0][:2],
+                         (3, 4))
+
+        # Identical vectors always share all bands
+        self.assertTrue(1 in idx.candidates([2, 3]))
+        self.assertEqual(idx.query(fvecs[1], k=1, approx=True)[0][0], 1)
+
+        path = tempfile.mkdtemp()
+        try:
+            idx.save(path)
+            loaded = index.Index.load(path)
+            self.assertEqual(loaded.query(fvecs[0], k=2), result)
+        finally:
+            shutil.rmtree(path)
+
+    def test_kernel(self):
+        fvecs = [{1: 1.0, 2: 2.0}, {2: 1.0}, {3: -1.0}, {1: 0.5, 3: 2.0},
+                 {}]
+        xs = utils.fvecs_to_csr(fvecs, 4)
+        dense = xs.toarray()
+        sq = (dense ** 2).sum(axis=1)
+
+        path = tempfile.mkdtemp()
+        try:
+            out = path + "/kernel.npy"
+            for kind in kernel.kernels:
+                gram = kernel.compute_gram(out, xs, kind=kind, gamma=0.5,
+                                           block=2, processes=1,
+                                           dtype=np.float64)
+                ref = np.dot(dense, dense.T)
+                if kind == "cosine":
+                    norms = np.sqrt(np.outer(sq, sq))
+                    norms[norms == 0] = 1.0
+                    ref = ref / norms
+                elif kind == "rbf":
+                    ref = np.exp(-0.5 * (sq[:, None] + sq[None, :] - 2 * ref))
+                self.assertTrue(np.allclose(gram, ref))
+
+            # Rectangular matrix of test vectors against training vectors
+            gram = kernel.compute_gram(out, xs[:2], xs, block=3,
+                                       processes=1, dtype=np.float64)
+            self.assertTrue(np.allclose(gram, np.dot(dense[:2], dense.T)))
+        finally:
+            shutil.rmtree(path)
 
 
 if __name__ == "__main__":
@@ -0,0 +1,59 @@
+#!/usr/bin/env python2
+# Siggi - Feature Hashing for Labeled Graphs
+# (c) 2015, 2017 Konrad Rieck (konrad@mlsec.org)
+
+import argparse
+
+import index
+import siggi
+import utils
+
+# Parse arguments
+parser = argparse.ArgumentParser(
+    description='Siggi - Build Similarity Index of Feature Vectors.',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter
+)
+parser.add_argument('input', metavar='libsvm',
+                    help='input file in libsvm format')
+parser.add_argument('-o', '--output', metavar='D', default="index",
+                    help='set output directory of index')
+parser.add_argument('-m', '--mode', metavar='N', default=0, type=int,
+                    help='set bag mode used for the feature vectors')
+parser.add_argument('-P', '--perms', metavar='N', default=64, type=int,
+                    help='set number of permutations for minhash')
+parser.add_argument('-B', '--bands', metavar='N', default=16, type=int,
+                    help='set number of bands for locality-sensitive hashing')
+siggi.add_arguments(parser)
+args = parser.parse_args()
+
+# Record settings for hashing query graphs the same way. Settings
+# stored by sg_map.py take precedence over the command line.
+hasher = siggi.Hasher.from_args(args, processes=0)
+settings = utils.load_settings(args.input)
+if settings:
+    print "= Loading settings from %s" % utils.settings_file(args.input)
+    stored = siggi.Hasher.from_settings(settings, processes=0)
+    differ = sorted(k for k, v in hasher.settings().items()
+                    if stored.settings()[k] != v)
+    if differ:
+        print "= Ignoring options differing from settings: %s" % \
+            ", ".join(differ)
+    hasher = stored
+
+print "= Loading feature vectors from %s" % args.input
+fvecs, labels = utils.load_libsvm(args.input)
+dim = max([0] + [max(fv) + 1 for fv in fvecs if fv])
+if dim > hasher.dim():
+    parser.error("feature vectors exceed %d bits; use the settings of "
+                 "sg_map.py" % hasher.args.bits)
+matrix = utils.fvecs_to_csr(fvecs, hasher.dim())
+del fvecs
+
+print "= Building index of %d vectors (%d perms, %d bands)" % (
+    matrix.shape[0], args.perms, args.bands
+)
+idx = index.Index.build(matrix, labels, args.perms, args.bands,
+                        meta={"settings": hasher.settings()})
+
+print "= Saving index to %s" % args.output
+idx.save(args.output)
@@ -0,0 +1,74 @@
+#!/usr/bin/env python2
+# Siggi - Feature Hashing for Labeled Graphs
+# (c) 2015, 2017 Konrad Rieck (konrad@mlsec.org)
+
+import argparse
+import sys
+
+import numpy as np
+import scipy.sparse as sp
+
+import kernel
+import utils
+
+# Parse arguments
+parser = argparse.ArgumentParser(
+    description='Siggi - Compute Kernel Matrix of Feature Vectors.',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter
+)
+parser.add_argument('input', metavar='libsvm',
+                    help='input file in libsvm format')
+parser.add_argument('-o', '--output', metavar='F', default="kernel.npy",
+                    help='set output file of kernel matrix (npy format)')
+parser.add_argument('-t', '--test', metavar='F', default=None,
+                    help='compute rectangular matrix of test vs. input file')
+parser.add_argument('-k', '--kernel', metavar='S', default="linear",
+                    help='set kernel function: %s' % "|".join(kernel.kernels))
+parser.add_argument('-g', '--gamma', metavar='F', default=1.0, type=float,
+                    help='set width parameter of rbf kernel')
+parser.add_argument('-B', '--block', metavar='N', default=1024, type=int,
+                    help='set number of rows and columns per block')
+parser.add_argument('-j', '--workers', metavar='N', default=None, type=int,
+                    help='set number of workers')
+parser.add_argument('-D', '--dtype', metavar='S', default="float32",
+                    help='set data type of kernel matrix: float32|float64')
+args = parser.parse_args()
+
+if args.kernel not in kernel.kernels:
+    parser.error("unknown kernel '%s'" % args.kernel)
+if args.dtype not in ["float32", "float64"]:
+    parser.error("unknown data type '%s'" % args.dtype)
+
+
+def load(filename):
+    """ Load libsvm file block-wise into a sparse matrix """
+    blocks = [m for m, _ in utils.iter_libsvm(filename)]
+    if not blocks:
+        return sp.csr_matrix((0, 1))
+    dim = max(m.shape[1] for m in blocks)
+    blocks = [sp.csr_matrix((m.data, m.indices, m.indptr),
+                            shape=(m.shape[0], dim)) for m in blocks]
+    return sp.vstack(blocks, format="csr")
+
+
+def progress(frac):
+    sys.stdout.write("\r= Computed %5.1f%% of kernel matrix" % (100 * frac))
+    sys.stdout.flush()
+
+
+print "= Loading feature vectors from %s" % args.input
+xs = load(args.input)
+ys = None
+if args.test:
+    print "= Loading test vectors from %s" % args.test
+    xs, ys = load(args.test), xs
+
+print "= Computing %s kernel matrix (%d x %d) in blocks of %d" % (
+    args.kernel, xs.shape[0], (ys if ys is not None else xs).shape[0],
+    args.block
+)
+kernel.compute_gram(args.output, xs, ys, args.kernel, args.gamma,
+                    args.block, args.workers, np.dtype(args.dtype),
+                    progress)
+print
+print "= Saved kernel matrix to %s" % args.output
@@ -3,8 +3,8 @@
 # (c) 2015, 2017 Konrad Rieck (konrad@mlsec.org)
 
 import argparse
-from multiprocessing import Pool
 
+import pipeline
 import siggi
 import utils
 
@@ -23,47 +23,62 @@ parser.add_argument('-r', '--regex', metavar='R', default="^\d+",
                     help='set regex for labels in filenames')
 parser.add_argument('-c', '--chunks', metavar='N', default=1, type=int,
                     help='set number of chunks to process')
+parser.add_argument('-q', '--queue', metavar='N', default=0, type=int,
+                    help='set maximum number of graphs in flight (0 = auto)')
+parser.add_argument('-u', '--dedup', metavar='S', default="none",
+                    help='skip duplicate graphs: none|content|structure')
+parser.add_argument('-x', '--max-memory', metavar='S', default="0",
+                    help='set memory budget of graphs in flight (0 = none)')
 siggi.add_arguments(parser)
 
 args = parser.parse_args()
-siggi.set_args(args)
+if args.dedup not in pipeline.dedups:
+    parser.error("unknown deduplication '%s'" % args.dedup)
+try:
+    memory = utils.parse_size(args.max_memory)
+except Exception as e:
+    parser.error(str(e).lower())
+hasher = siggi.Hasher.from_args(args)
 
-# Initialize pool for multi-threading
-pool = Pool()
-
-# Loop over bundles on command line
-for i, bundle in enumerate(args.bundle):
-    # Get entries and create chunks
+# Collect jobs of chunks from all bundles
+jobs = []
+for bundle in args.bundle:
     entries = utils.list_bundle(bundle)
-    chunks = utils.chunkify_entries(entries, args.chunks)
-    for j, chunk in enumerate(chunks):
+    for chunk in utils.chunkify_entries(entries, args.chunks):
+        jobs.append((bundle, chunk))
 
-        print "= Loading %d graphs from bundle %s" % (len(chunk), bundle)
-        graphs, labels = utils.load_bundle(bundle, args.regex, chunk=chunk)
 
-        print "= Extracting %s from graphs" % siggi.bag_name(args.mode)
-        func = getattr(siggi, siggi.modes[args.mode])
-        bags = pool.map(func, graphs)
-        del graphs
+def report(job):
+    bundle, chunk = jobs[job]
+    print "= Processing %d graphs from bundle %s" % (len(chunk), bundle)
 
-        # Convert bags to feature vectors
-        print "= Hashing bags to feature vectors (%d bits)" % args.bits
-        items = pool.map(siggi.bag_to_fvec, bags)
-        fvecs, fmaps = zip(*items)
-        del bags
 
-        # Normalizing feature vectors
-        print "= Normalizing feature vectors (%s, %s)" % (args.map, args.norm)
-        fvecs = pool.map(siggi.fvec_norm, fvecs)
+print "= Extracting %s from graphs" % hasher.name()
+print "= Hashing bags to feature vectors (%d bits)" % args.bits
+print "= Normalizing feature vectors (%s, %s, %s)" % (
+    args.map, args.weight, args.norm
+)
+print "= Saving feature vectors to %s" % args.output
+if memory > 0:
+    print "= Bounding memory of graphs in flight to %s" % args.max_memory
 
-        if i == 0 and j == 0:
-            print "= Saving feature vectors to %s" % args.output
-            utils.save_libsvm(args.output, fvecs, labels)
-        else:
-            print "= Appending feature vectors to %s" % args.output
-            utils.save_libsvm(args.output, fvecs, labels, append=True)
+# Read, extract and write bundles in an overlapping pipeline
+pipe = pipeline.Pipeline(hasher, args.regex, args.queue, dedup=args.dedup,
+                         memory=memory)
+total, fmaps = pipe.run(jobs, args.output, report)
+utils.save_settings(args.output, hasher.settings())
+print "= Processed %d graphs" % total
+if args.dedup != "none":
+    print "= Skipped %d duplicates (%.1f%% hit rate)" % (
+        pipe.hits, 100.0 * pipe.hits / max(1, total)
+    )
+if pipe.budget:
+    print "= Estimated peak memory %.1fM (%.1f bytes per input byte)" % (
+        pipe.budget.peak / 1024.0 ** 2, pipe.budget.ratio
+    )
 
 if args.fmap:
     print "= Saving feature map to %s" % args.fmap
     utils.save_fmap(args.fmap, fmaps)
 
+hasher.close()
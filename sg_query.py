@@ -0,0 +1,74 @@
+#!/usr/bin/env python2
+# Siggi - Feature Hashing for Labeled Graphs
+# (c) 2015, 2017 Konrad Rieck (konrad@mlsec.org)
+
+import argparse
+import zipfile as zf
+
+import index
+import siggi
+import utils
+
+# Parse arguments
+parser = argparse.ArgumentParser(
+    description='Siggi - Query Nearest Neighbors of Graphs.',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter
+)
+parser.add_argument('index', metavar='index',
+                    help='index directory built with sg_index.py')
+parser.add_argument('graphs', metavar='graph', nargs='+',
+                    help='graph files (dot/graphml) or graph bundles')
+parser.add_argument('-k', '--neighbors', metavar='N', default=10, type=int,
+                    help='set number of nearest neighbors')
+parser.add_argument('-a', '--approx', default=False, action='store_true',
+                    help='use locality-sensitive hashing for queries')
+parser.add_argument('-x', '--metric', metavar='S', default='cosine',
+                    help='set similarity metric: cosine or dot')
+args = parser.parse_args()
+
+
+def load_graphs(filenames):
+    """ Yield names and graphs from graph files and bundles """
+
+    for filename in filenames:
+        if filename.endswith(".zip"):
+            archive = zf.ZipFile(filename)
+            for entry in utils.list_bundle(filename):
+                data = archive.read(entry)
+                yield entry, utils.parse_graph(data, utils.entry_format(entry))
+            archive.close()
+        else:
+            format = utils.entry_format(filename)
+            if not format:
+                raise Exception("Unknown format of %s" % filename)
+            with open(filename) as f:
+                yield filename, utils.parse_graph(f.read(), format)
+
+
+print "= Loading index from %s" % args.index
+idx = index.Index.load(args.index)
+
+# Hash graphs with the settings of the index
+hasher = siggi.Hasher.from_settings(idx.meta["settings"], processes=0)
+
+# Document frequencies can be recovered from the index
+weight = hasher.args.weight.lower()
+if weight == "idf":
+    hasher.weighting = siggi.Weighting(weight, hasher.dim())
+    hasher.weighting.count = len(idx)
+    df = idx.frequencies()[:hasher.dim()]
+    hasher.weighting.df[:len(df)] = df
+elif weight != "none":
+    raise Exception("Weighting '%s' not supported for queries" % weight)
+
+print "= Querying %s in %d vectors" % (hasher.name(), len(idx))
+for name, graph in load_graphs(args.graphs):
+    matrix = hasher.transform_many([graph])
+    fvec = utils.csr_to_fvecs(matrix)[0]
+    result = idx.query(fvec, args.neighbors, args.metric, args.approx)
+
+    print "= Nearest neighbors of %s" % name
+    for rank, (row, label, score) in enumerate(result):
+        print "  %3d. vector %d (label %d): %.6f" % (
+            rank + 1, row, label, score
+        )
@@ -0,0 +1,276 @@
+#!/usr/bin/env python2
+# Siggi - Feature Hashing for Labeled Graphs
+# (c) 2015, 2017 Konrad Rieck (konrad@mlsec.org)
+
+import argparse
+import collections
+import json
+import os
+import threading
+import time
+import BaseHTTPServer
+import Queue
+import SocketServer
+import urlparse
+from functools import partial
+
+import siggi
+import utils
+
+# Parse arguments
+parser = argparse.ArgumentParser(
+    description='Siggi - Feature Hashing Server for Labeled Graphs.',
+    formatter_class=argparse.ArgumentDefaultsHelpFormatter
+)
+parser.add_argument('-m', '--mode', metavar='N', default=0, type=int,
+                    help='set bag mode for feature hashing')
+parser.add_argument('-H', '--host', metavar='S', default='127.0.0.1',
+                    help='set host to listen on')
+parser.add_argument('-P', '--port', metavar='N', default=8642, type=int,
+                    help='set port to listen on')
+parser.add_argument('-u', '--socket', metavar='F', default=None,
+                    help='listen on unix socket instead of host and port')
+parser.add_argument('-j', '--workers', metavar='N', default=None, type=int,
+                    help='set number of workers (0 = no pool)')
+parser.add_argument('-B', '--batch', metavar='N', default=64, type=int,
+                    help='set maximum number of graphs per batch')
+parser.add_argument('-W', '--wait', metavar='N', default=1.0, type=float,
+                    help='set time in ms to wait for filling a batch')
+siggi.add_arguments(parser)
+
+
+def process_payload(item, mode, conf):
+    """ Parse a payload and map it to a feature vector """
+    data, format = item
+
+    try:
+        graph = utils.parse_graph(data, format)
+        return siggi.graph_to_fvec(graph, mode, conf), None
+    except Exception as e:
+        return None, "%s: %s" % (type(e).__name__, e)
+
+
+class Stats(object):
+    """ Counters for requests, latency and throughput """
+
+    def __init__(self, window=10000):
+        self.lock = threading.Lock()
+        self.start = time.time()
+        self.requests = 0
+        self.graphs = 0
+        self.errors = 0
+        self.batches = 0
+        self.latency = 0.0
+        self.recent = collections.deque(maxlen=window)
+
+    def add_batch(self, size):
+        with self.lock:
+            self.batches += 1
+            self.graphs += size
+
+    def add_request(self, latency, error=False):
+        with self.lock:
+            self.requests += 1
+            self.errors += int(error)
+            self.latency += latency
+            self.recent.append(latency)
+
+    def report(self):
+        with self.lock:
+            uptime = time.time() - self.start
+            recent = sorted(self.recent)
+            stats = {
+                "uptime": uptime,
+                "requests": self.requests,
+                "graphs": self.graphs,
+                "errors": self.errors,
+                "batches": self.batches,
+                "throughput": self.graphs / uptime if uptime > 0 else 0.0,
+                "batch_mean": (float(self.graphs) / self.batches
+                               if self.batches > 0 else 0.0),
+                "latency_mean": (1000 * self.latency / self.requests
+                                 if self.requests > 0 else 0.0),
+            }
+
+        # Percentiles over the most recent requests (in ms)
+        for p in [50, 90, 99]:
+            if recent:
+                i = min(len(recent) - 1, int(p / 100.0 * len(recent)))
+                stats["latency_p%d" % p] = 1000 * recent[i]
+            else:
+                stats["latency_p%d" % p] = 0.0
+
+        return stats
+
+
+class Batcher(threading.Thread):
+    """ Collect concurrent requests and hash them in batches """
+
+    def __init__(self, hasher, size, wait, stats):
+        threading.Thread.__init__(self)
+        self.daemon = True
+        self.queue = Queue.Queue()
+        self.hasher = hasher
+        self.func = partial(process_payload, mode=hasher.mode,
+                            conf=hasher.args)
+        self.size = size
+        self.wait = wait / 1000.0
+        self.stats = stats
+
+    def submit(self, data, format):
+        """ Submit payload and block until its vector is ready """
+        job = {"item": (data, format), "done": threading.Event()}
+        self.queue.put(job)
+        job["done"].wait()
+        return job["result"]
+
+    def run(self):
+        while True:
+            # Block for first job, then fill batch for a short time
+            jobs = [self.queue.get()]
+            deadline = time.time() + self.wait
+            while len(jobs) < self.size:
+                timeout = deadline - time.time()
+                try:
+                    if timeout > 0:
+                        jobs.append(self.queue.get(timeout=timeout))
+                    else:
+                        jobs.append(self.queue.get_nowait())
+                except Queue.Empty:
+                    break
+
+            items = [job["item"] for job in jobs]
+            try:
+                results = self.hasher.map(self.func, items)
+            except Exception as e:
+                # Keep serving if the pool fails for a batch
+                error = "%s: %s" % (type(e).__name__, e)
+                results = [(None, error)] * len(items)
+            self.stats.add_batch(len(items))
+
+            for job, result in zip(jobs, results):
+                job["result"] = result
+                job["done"].set()
+
+
+class Handler(BaseHTTPServer.BaseHTTPRequestHandler):
+    """ HTTP interface of the hashing server """
+
+    def address_string(self):
+        # Unix sockets have no client address
+        if isinstance(self.client_address, tuple):
+            return self.client_address[0]
+        return "unix"
+
+    def send_data(self, code, data, ctype="text/plain", latency=None):
+        self.send_response(code)
+        self.send_header("Content-Type", ctype)
+        self.send_header("Content-Length", str(len(data)))
+        if latency is not None:
+            self.send_header("X-Siggi-Time", "%.3f" % (1000 * latency))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def do_GET(self):
+        url = urlparse.urlparse(self.path)
+        if url.path == "/stats":
+            stats = self.server.stats.report()
+            self.send_data(200, json.dumps(stats), "application/json")
+        else:
+            self.send_data(404, "Not found\n")
+
+    def do_POST(self):
+        start = time.time()
+        url = urlparse.urlparse(self.path)
+        if url.path != "/hash":
+            self.send_data(404, "Not found\n")
+            return
+
+        query = dict(urlparse.parse_qsl(url.query))
+        try:
+            length = int(self.headers.getheader("Content-Length", 0))
+            label = int(query.get("label", 0))
+        except ValueError:
+            self.server.stats.add_request(time.time() - start, True)
+            self.send_data(400, "Invalid length or label\n")
+            return
+        data = self.rfile.read(length)
+
+        # Guess format of graph if not given
+        format = query.get("format")
+        if not format:
+            format = "graphml" if data.lstrip().startswith("<") else "dot"
+        output = query.get("output", "libsvm")
+
+        if format not in ["dot", "graphml"] or \
+                output not in ["libsvm", "json"]:
+            self.server.stats.add_request(time.time() - start, True)
+            self.send_data(400, "Unknown format or output\n")
+            return
+
+        fvec, error = self.server.batcher.submit(data, format)
+        latency = time.time() - start
+        self.server.stats.add_request(latency, error is not None)
+
+        if error:
+            self.send_data(400, error + "\n", latency=latency)
+        elif output == "json":
+            fvec = {str(k): v for k, v in fvec.items()}
+            data = json.dumps({"label": label, "fvec": fvec})
+            self.send_data(200, data, "application/json", latency)
+        else:
+            data = utils.format_libsvm(fvec, label) + "\n"
+            self.send_data(200, data, latency=latency)
+
+    def log_message(self, format, *args):
+        # Logging each request costs more than hashing small graphs
+        pass
+
+
+class HTTPServer(SocketServer.ThreadingMixIn, BaseHTTPServer.HTTPServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+class UnixHTTPServer(SocketServer.ThreadingMixIn,
+                     SocketServer.UnixStreamServer):
+    daemon_threads = True
+    request_queue_size = 128
+
+
+if __name__ == "__main__":
+    args = parser.parse_args()
+    if args.weight.lower() != "none":
+        parser.error("corpus weighting is not supported in server mode")
+    hasher = siggi.Hasher.from_args(args, processes=args.workers)
+
+    # Start worker pool before serving the first request
+    hasher.start()
+    stats = Stats()
+    batcher = Batcher(hasher, args.batch, args.wait, stats)
+    batcher.start()
+
+    if args.socket:
+        if os.path.exists(args.socket):
+            os.unlink(args.socket)
+        server = UnixHTTPServer(args.socket, Handler)
+        where = args.socket
+    else:
+        server = HTTPServer((args.host, args.port), Handler)
+        where = "http://%s:%d" % (args.host, args.port)
+
+    server.stats = stats
+    server.batcher = batcher
+
+    print("= Serving %s (%d bits) on %s" % (
+        hasher.name(), args.bits, where
+    ))
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        hasher.close()
+        if args.socket and os.path.exists(args.socket):
+            os.unlink(args.socket)
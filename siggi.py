@@ -1,7 +1,19 @@
 # Siggi - Feature Hashing for Labeled Graphs
 # (c) 2015 Konrad Rieck (konrad@mlsec.org)
 
+import argparse
+import copy
+import hashlib
+import itertools
+import math
+import random
+from array import array
+from functools import partial
+from multiprocessing import Pool
+
 import networkx as nx
+import numpy as np
+import scipy.sparse as sp
 import string
 
 import utils
@@ -37,10 +49,19 @@ def add_arguments(parser):
                         help='set size of neighborhoods')
     parser.add_argument('-d', '--depth', metavar='N', default=5, type=int,
                         help='set depth of reachabilities')
+    parser.add_argument('-S', '--sample', metavar='N', default=0, type=int,
+                        help='set number of sampled sources for paths and '
+                             'reachabilities (0 = all)')
+    parser.add_argument('-T', '--strata', metavar='S', default='uniform',
+                        help='set sampling of sources: uniform or degree')
+    parser.add_argument('-R', '--seed', metavar='N', default=0, type=int,
+                        help='set seed for sampling of sources')
     parser.add_argument('-n', '--norm', metavar='S', default='none',
                         help='set vector norm: l1, l2 or none')
     parser.add_argument('-M', '--map', metavar='S', default='count',
-                        help='set map type: binary or count')
+                        help='set map type: binary, count or log')
+    parser.add_argument('-w', '--weight', metavar='S', default='none',
+                        help='set corpus weighting: idf, maxabs or none')
     parser.add_argument('-p', '--label', metavar='S', default='label',
                         help='set name of label property')
 
@@ -51,11 +72,12 @@ def set_args(pargs):
     args = pargs
 
 
-def node_label(node):
+def node_label(node, conf=None):
     """ Return the label of a node """
 
+    conf = conf or args
     output = []
-    labels = map(str.strip, args.label.split(","))
+    labels = map(str.strip, conf.label.split(","))
 
     for label in labels:
         if label in node:
@@ -66,27 +88,153 @@ def node_label(node):
     return '|'.join(output)
 
 
-def bag_name(m):
+def structure_hash(graph, conf=None):
+    """ Compute hash of the labeled structure of a graph. Node labels are
+        refined by the labels of their predecessors and successors until
+        the partition of the nodes is stable (Weisfeiler-Lehman). Graphs
+        that differ only in node names, unused attributes or formatting
+        get the same hash. The hash is not a canonical form: graphs not
+        distinguished by the refinement collide, e.g., a cycle of six
+        nodes and two cycles of three nodes with equal labels. Use
+        same_structure to confirm that graphs are isomorphic. """
+
+    conf = conf or args
+    nodes = graph.nodes()
+    colors = {x: node_label(graph.node[x], conf) for x in nodes}
+
+    # Adjacency with multiple edges, undirected edges in both directions
+    succ = {x: [] for x in nodes}
+    pred = {x: [] for x in nodes}
+    for i, j in graph.edges():
+        succ[i].append(j)
+        pred[j].append(i)
+        if not graph.is_directed():
+            succ[j].append(i)
+            pred[i].append(j)
+
+    count = len(set(colors.values()))
+    for _ in range(len(nodes)):
+        refined = {}
+        for x in nodes:
+            key = (colors[x], sorted(colors[y] for y in succ[x]),
+                   sorted(colors[y] for y in pred[x]))
+            refined[x] = hashlib.md5(repr(key)).digest()
+        colors = refined
+
+        # Stop if no class of nodes has been split
+        if len(set(colors.values())) == count:
+            break
+        count = len(set(colors.values()))
+
+    key = (graph.is_directed(), sorted(colors.values()))
+    return hashlib.sha1(repr(key)).hexdigest()
+
+
+def labeled_structure(graph, conf=None):
+    """ Return copy of graph with the node label as only attribute """
+
+    conf = conf or args
+    result = nx.MultiDiGraph() if graph.is_directed() else nx.MultiGraph()
+    for x in graph.nodes():
+        result.add_node(x, label=node_label(graph.node[x], conf))
+    result.add_edges_from(graph.edges())
+
+    return result
+
+
+def same_structure(graph1, graph2):
+    """ Check whether two labeled structures are isomorphic """
+
+    match = lambda a, b: a["label"] == b["label"]
+    return nx.is_isomorphic(graph1, graph2, node_match=match)
+
+
+def bag_name(m, conf=None):
     """ Return the name and config of a bag mode """
 
+    conf = conf or args
     s = modes[m].replace("_", " ")
     s = s.replace("bag of", "bags of")
 
     if m == 2:
-        s += " (size: %d)" % args.size
+        s += " (size: %d)" % conf.size
     elif m == 3:
-        s += " (depth: %d)" % args.depth
+        s += " (depth: %d" % conf.depth
     elif m == 4:
-        s += " (min: %d, max: %d)" % (args.minlen, args.maxlen)
+        s += " (min: %d, max: %d" % (conf.minlen, conf.maxlen)
+
+    if m in [3, 4]:
+        if conf.sample > 0:
+            s += ", sample: %d %s" % (conf.sample, conf.strata)
+        s += ")"
     return s
 
 
-def bag_of_nodes(graph):
+def sample_sources(graph, nodes, conf=None):
+    """ Sample source nodes for approximating paths and reachabilities.
+        Returns the indices of the sampled nodes and their weights, that
+        is, the inverse probability of each node being sampled. Returns
+        None if all nodes are used. """
+
+    conf = conf or args
+    n = len(nodes)
+    if conf.sample <= 0 or conf.sample >= n:
+        return None
+
+    rng = random.Random(conf.seed)
+    strata = conf.strata.lower()
+    if strata == "uniform":
+        groups = [list(range(n))]
+    elif strata == "degree":
+        # Stratify by logarithmic out-degree
+        degree = graph.out_degree if graph.is_directed() else graph.degree
+        groups = {}
+        for i, x in enumerate(nodes):
+            k = int(math.log(degree(x) + 1, 2))
+            groups.setdefault(k, []).append(i)
+        groups = [groups[k] for k in sorted(groups)]
+    else:
+        raise Exception("Unknown sampling of sources '%s'" % strata)
+
+    sources, weights = [], []
+    if conf.sample >= len(groups):
+        # One source per stratum, the rest proportional to the remaining
+        # nodes using largest remainders in random order of ties
+        spare = conf.sample - len(groups)
+        quotas = [float(spare) * (len(g) - 1) / (n - len(groups))
+                  for g in groups]
+        sizes = [int(q) for q in quotas]
+        rest = sorted(range(len(groups)),
+                      key=lambda i: (sizes[i] - quotas[i], rng.random()))
+        for i in rest[:spare - sum(sizes)]:
+            sizes[i] += 1
+
+        for group, size in zip(groups, sizes):
+            sources.extend(rng.sample(group, size + 1))
+            weights.extend([float(len(group)) / (size + 1)] * (size + 1))
+    else:
+        # Too few sources for all strata: round the proportional quotas
+        # systematically, so that each node is included with probability
+        # sample / n and weighted by its inverse
+        start = rng.random()
+        total = 0.0
+        for group in groups:
+            quota = float(conf.sample) * len(group) / n
+            size = int(total + quota + start) - int(total + start)
+            total += quota
+            sources.extend(rng.sample(group, size))
+            weights.extend([float(n) / conf.sample] * size)
+
+    return sources, weights
+
+
+def bag_of_nodes(graph, conf=None):
     """ Build bag of nodes from graph """
 
+    conf = conf or args
     bag = {}
     for i in graph.nodes():
-        label = node_label(graph.node[i])
+        label = node_label(graph.node[i], conf)
         if label not in bag:
             bag[label] = 0
         bag[label] += 1
@@ -94,13 +242,14 @@ def bag_of_nodes(graph):
     return bag
 
 
-def bag_of_edges(graph):
+def bag_of_edges(graph, conf=None):
     """ Build bag of edges from graph """
 
+    conf = conf or args
     bag = {}
     for i, j in graph.edges():
-        n1 = node_label(graph.node[i])
-        n2 = node_label(graph.node[j])
+        n1 = node_label(graph.node[i], conf)
+        n2 = node_label(graph.node[j], conf)
         label = "%s-%s" % (n1, n2)
         if label not in bag:
             bag[label] = 0
@@ -109,91 +258,204 @@ def bag_of_edges(graph):
     return bag
 
 
-def bag_of_neighborhoods(graph):
+def bag_of_neighborhoods(graph, conf=None):
     """ Build bag of neighborhoods for graph """
 
-    paths = nx.all_pairs_shortest_path(graph, cutoff=args.size)
+    conf = conf or args
+    names, uniq, blocks = __reachable_labels(graph, conf.size, conf)
 
     bag = {}
-    for i in paths:
-        reachable = filter(lambda x: x != i, paths[i].keys())
-        n = node_label(graph.node[i])
-        ns = map(lambda x: node_label(graph.node[x]), reachable)
-        label = "%s:%s" % (n, '-'.join(sorted(ns)))
+    for block, sources, labels, counts in blocks:
+        bounds = np.searchsorted(sources, np.arange(len(block) + 1))
+        bounds = bounds.tolist()
+        labels, counts = labels.tolist(), counts.tolist()
 
-        if label not in bag:
-            bag[label] = 0.0
-        bag[label] += 1.0
+        for k, source in enumerate(block.tolist()):
+            ns = []
+            for i in range(bounds[k], bounds[k + 1]):
+                ns.extend([uniq[labels[i]]] * counts[i])
+            label = "%s:%s" % (names[source], '-'.join(ns))
+
+            if label not in bag:
+                bag[label] = 0.0
+            bag[label] += 1.0
 
     return bag
 
 
-def bag_of_reachabilities(graph):
+def bag_of_reachabilities(graph, conf=None):
     """ Build bag of reachabilities for graph """
 
-    paths = nx.all_pairs_shortest_path(graph, cutoff=args.depth)
+    conf = conf or args
+    nodes = graph.nodes()
+    sample = sample_sources(graph, nodes, conf)
+    if sample:
+        sources, weights = sample
+        weight = np.zeros(len(nodes))
+        weight[sources] = weights
+    else:
+        sources, weight = None, np.ones(len(nodes))
+
+    names, uniq, blocks = __reachable_labels(graph, conf.depth, conf,
+                                             nodes, sources)
+    lids = {label: i for i, label in enumerate(uniq)}
+    lid = np.array([lids[label] for label in names], dtype=np.int64)
+
+    # Aggregate counts of label pairs before building strings
+    def merge(keys, counts):
+        keys, inverse = np.unique(np.concatenate(keys), return_inverse=True)
+        return keys, np.bincount(inverse, weights=np.concatenate(counts))
+
+    keys, counts = [np.zeros(0, dtype=np.int64)], [np.zeros(0)]
+    for block, sources, labels, cnts in blocks:
+        keys.append(lid[block[sources]] * len(uniq) + labels)
+        counts.append(cnts * weight[block[sources]])
+        if len(keys) == 256:
+            keys, counts = [[x] for x in merge(keys, counts)]
+
+    keys, counts = merge(keys, counts)
 
     bag = {}
-    for i in paths:
-        reachable = list(filter(lambda x: x != i, paths[i].keys()))
-        if len(reachable) == 0:
-            continue
-
-        for j in reachable:
-            n1 = node_label(graph.node[i])
-            n2 = node_label(graph.node[j])
-            label = "%s:%s" % (n1, n2)
-
-            if label not in bag:
-                bag[label] = 0.0
-            bag[label] += 1.0
+    for key, count in zip(keys.tolist(), counts.tolist()):
+        n1, n2 = divmod(key, len(uniq))
+        label = "%s:%s" % (uniq[n1], uniq[n2])
+        bag[label] = count
 
     return bag
 
 
-def bag_of_shortest_paths(graph):
+def __reachable_labels(graph, cutoff, conf=None, nodes=None,
+                       sources=None):
+    """ Determine the labels of nodes reachable from each source node
+        within cutoff hops. The traversal is bit-parallel: each node
+        holds a 64-bit word marking which of 64 sources have reached it.
+
+        Returns the label of each node, the sorted unique labels and a
+        generator of blocks (block, sources, labels, counts). The array
+        block holds the indices of up to 64 source nodes. The other
+        arrays list the offset of a source in the block, the index of a
+        reachable label and its count, sorted by source and label.
+        Sources do not reach themselves. """
+
+    if nodes is None:
+        nodes = graph.nodes()
+    if sources is None:
+        sources = range(len(nodes))
+    names = [node_label(graph.node[x], conf) for x in nodes]
+    uniq = sorted(set(names))
+    blocks = __reachable_blocks(graph, nodes, names, uniq, cutoff, sources)
+    return names, uniq, blocks
+
+
+def __reachable_blocks(graph, nodes, names, uniq, cutoff, sources):
+    """ Generate blocks of reachable labels (see __reachable_labels) """
+
+    n = len(nodes)
+    sources = np.array(sources, dtype=np.int64)
+    index = {x: i for i, x in enumerate(nodes)}
+    lids = {label: i for i, label in enumerate(uniq)}
+    lid = np.array([lids[label] for label in names], dtype=np.int64)
+
+    # Edge list sorted by target node
+    edges = [(index[i], index[j]) for i, j in graph.edges()]
+    if not graph.is_directed():
+        edges += [(j, i) for i, j in edges]
+    edges = np.array(edges, dtype=np.int64).reshape(-1, 2)
+    order = np.argsort(edges[:, 1], kind="mergesort")
+    src, dst = edges[order, 0], edges[order, 1]
+
+    bits = np.left_shift(np.uint64(1), np.arange(64, dtype=np.uint64))
+    for start in range(0, len(sources), 64):
+        block = sources[start:start + 64]
+        size = len(block)
+
+        # Mark each source of the block as reached by itself
+        visited = np.zeros(n, dtype=np.uint64)
+        visited[block] = bits[:size]
+        frontier = visited.copy()
+
+        for _ in range(cutoff):
+            # Propagate words of active nodes to their successors
+            active = np.flatnonzero(frontier[src])
+            if len(active) == 0:
+                break
+            words = frontier[src[active]]
+            targets = dst[active]
+            first = np.flatnonzero(np.r_[True, targets[1:] != targets[:-1]])
+
+            frontier = np.zeros(n, dtype=np.uint64)
+            frontier[targets[first]] = np.bitwise_or.reduceat(words, first)
+            frontier &= ~visited
+            visited |= frontier
+
+        visited[block] &= ~bits[:size]
+
+        # Unpack reached bits of nonzero words to pairs of node and source
+        reached = np.flatnonzero(visited)
+        octets = visited[reached].astype("<u8").view(np.uint8)
+        unpacked = np.unpackbits(octets.reshape(-1, 8, 1), axis=2)
+        unpacked = unpacked[:, :, ::-1].reshape(-1, 64)
+        rows, cols = np.nonzero(unpacked)
+
+        # Count labels per source, sorted by source and label
+        keys = cols * len(uniq) + lid[reached[rows]]
+        keys, counts = np.unique(keys, return_counts=True)
+        offsets, labels = keys // len(uniq), keys % len(uniq)
+
+        yield block, offsets, labels, counts
+
+
+def bag_of_shortest_paths(graph, conf=None):
     """ Build bag of shortest path for graph """
 
-    paths = nx.all_pairs_shortest_path(graph, cutoff=args.maxlen)
+    conf = conf or args
+    nodes = graph.nodes()
+    sample = sample_sources(graph, nodes, conf)
+    if sample:
+        sources = [(nodes[i], w) for i, w in zip(*sample)]
+    else:
+        sources = [(x, 1.0) for x in nodes]
 
     bag = {}
-    for i in paths:
-        for j in paths[i]:
+    for i, weight in sources:
+        paths = nx.single_source_shortest_path(graph, i, cutoff=conf.maxlen)
+        for j in paths:
             path = list(map(
-                lambda x: node_label(graph.node[x]), paths[i][j]
+                lambda x: node_label(graph.node[x], conf), paths[j]
             ))
-            if len(path) - 1 < args.minlen:
+            if len(path) - 1 < conf.minlen:
                 continue
 
             label = '-'.join(path)
             if label not in bag:
                 bag[label] = 0.0
-            bag[label] += 1.0
+            bag[label] += weight
 
     return bag
 
 
-def bag_of_connected_components(graph):
+def bag_of_connected_components(graph, conf=None):
     """ Bag of strongly connected components """
     comp = nx.strongly_connected_components(graph)
-    return __bag_of_components(graph, comp)
+    return __bag_of_components(graph, comp, conf)
 
 
-def bag_of_attracting_components(graph):
+def bag_of_attracting_components(graph, conf=None):
     """ Bag of attracting components """
     # Hack to deal with broken nx implementation
     if len(graph.node) == 0:
         return {}
     comp = nx.attracting_components(graph)
-    return __bag_of_components(graph, comp)
+    return __bag_of_components(graph, comp, conf)
 
 
-def __bag_of_components(graph, comp):
+def __bag_of_components(graph, comp, conf=None):
     """ Build bag of components for graph """
 
+    conf = conf or args
     bag = {}
     for nodes in comp:
-        ns = map(lambda x: node_label(graph.node[x]), nodes)
+        ns = map(lambda x: node_label(graph.node[x], conf), nodes)
         label = '-'.join(sorted(ns))
         if label not in bag:
             bag[label] = 0
@@ -202,12 +464,13 @@ def __bag_of_components(graph, comp):
     return bag
 
 
-def bag_of_elementary_cycles(graph):
+def bag_of_elementary_cycles(graph, conf=None):
     """ Bag of elementary cycles """
 
+    conf = conf or args
     bag = {}
     for cycle in nx.simple_cycles(graph):
-        ns = list(map(lambda x: node_label(graph.node[x]), cycle))
+        ns = list(map(lambda x: node_label(graph.node[x], conf), cycle))
 
         # Determine smallest label and rotate cycle
         i = min(enumerate(ns), key=lambda x: x[1])[0]
@@ -222,16 +485,18 @@ def bag_of_elementary_cycles(graph):
     return bag
 
 
-def bag_of_branchless_paths(graph):
+def bag_of_branchless_paths(graph, conf=None):
     """ Bag of branchless paths """
 
+    conf = conf or args
     bag = {}
+    graph = graph.copy()
     for i in graph.nodes():
         if graph.out_degree(i) > 1:
             graph.remove_node(i)
 
     for nodes in nx.weakly_connected_components(graph):
-        ns = sorted(map(lambda x: node_label(graph.node[x]), nodes))
+        ns = sorted(map(lambda x: node_label(graph.node[x], conf), nodes))
         label = '-'.join(reversed(ns))
         if label not in bag:
             bag[label] = 0
@@ -240,15 +505,16 @@ def bag_of_branchless_paths(graph):
     return bag
 
 
-def bag_to_fvec(bag):
+def bag_to_fvec(bag, conf=None):
     """ Map bag to sparse feature vector """
 
+    conf = conf or args
     fvec = {}
     hashes = {}
 
     for key in bag:
         hash = utils.murmur3(key)
-        dim = (hash & (1 << args.bits) - 1) + 1
+        dim = (hash & (1 << conf.bits) - 1) + 1
         sign = 2 * (hash >> 31) - 1
 
         if dim not in fvec:
@@ -256,38 +522,448 @@ def bag_to_fvec(bag):
         fvec[dim] += sign * bag[key]
 
         # Store dim-key mapping
-        if args.fmap:
+        if conf.fmap:
             if dim not in hashes:
                 hashes[dim] = set()
             if key not in hashes[dim]:
                 hashes[dim].add(key)
 
-    return fvec, hashes if args.fmap else None
+    fvec = utils.SparseVector.from_dict(fvec)
+    return fvec, hashes if conf.fmap else None
+
 
+def fvec_norm(fvec, conf=None):
+    """ Normalization of feature vector (in place) """
 
-def fvec_norm(fvec):
-    """ Normalization of feature vector """
+    conf = conf or args
+    dims, vals = fvec.keys(), fvec.values()
 
-    mtype = args.map.lower()
+    mtype = conf.map.lower()
     if mtype == "binary":
-        for k in fvec.keys():
-            fvec[k] = 1.0
+        vals = [1.0] * len(vals)
+    elif mtype == "log":
+        vals = [math.copysign(math.log(1 + abs(x)), x) for x in vals]
     elif mtype != "count":
         raise Exception("Unknown map type '%s'" % mtype)
 
-    norm = args.norm.lower()
+    norm = conf.norm.lower()
     if norm == "l1" or norm == "manhattan":
-        total = map(lambda x: abs(x), fvec.values())
-        total = float(sum(total))
-        for k in fvec.keys():
-            fvec[k] /= total
+        total = float(sum(map(abs, vals)))
+        vals = [x / total for x in vals]
     elif norm == "l2" or norm == "euclidean":
-        total = map(lambda x: x * x, fvec.values())
-        total = float(sum(total)) ** 0.5
-        for k in fvec.keys():
-            fvec[k] /= total
+        total = float(sum(x * x for x in vals)) ** 0.5
+        vals = [x / total for x in vals]
     elif norm != "none":
         raise Exception("Unknown vector norm '%s'" % norm)
 
+    if isinstance(fvec, utils.SparseVector):
+        fvec.vals = array("d", vals)
+    else:
+        fvec.update(zip(dims, vals))
+
     return fvec
 
+
+def matrix_map(matrix, conf=None):
+    """ Map values of feature vectors in a sparse matrix """
+
+    conf = conf or args
+    matrix = sp.csr_matrix(matrix, dtype=np.float64, copy=True)
+
+    mtype = conf.map.lower()
+    if mtype == "binary":
+        matrix.data[:] = 1.0
+    elif mtype == "log":
+        matrix.data = np.sign(matrix.data) * np.log1p(np.abs(matrix.data))
+    elif mtype != "count":
+        raise Exception("Unknown map type '%s'" % mtype)
+
+    return matrix
+
+
+def matrix_norm(matrix, conf=None):
+    """ Normalization of feature vectors in a sparse matrix (in place) """
+
+    conf = conf or args
+    rows = np.repeat(np.arange(matrix.shape[0]), np.diff(matrix.indptr))
+
+    norm = conf.norm.lower()
+    if norm == "l1" or norm == "manhattan":
+        total = np.bincount(rows, np.abs(matrix.data), matrix.shape[0])
+    elif norm == "l2" or norm == "euclidean":
+        total = np.bincount(rows, matrix.data ** 2, matrix.shape[0])
+        total = np.sqrt(total)
+    elif norm == "none":
+        return matrix
+    else:
+        raise Exception("Unknown vector norm '%s'" % norm)
+
+    matrix.data /= total[rows]
+    return matrix
+
+
+class Weighting(object):
+    """ Corpus-level weighting of feature vectors. The statistics are
+        collected over all vectors in a first pass using update() and
+        applied to the vectors in a second pass using transform(). """
+
+    def __init__(self, scheme, dim):
+        self.scheme = scheme.lower()
+        if self.scheme not in ["idf", "maxabs", "none"]:
+            raise Exception("Unknown weighting '%s'" % scheme)
+
+        self.count = 0
+        self.df = np.zeros(dim, dtype=np.int64)
+        self.maxabs = np.zeros(dim, dtype=np.float64)
+        self.weights = None
+
+    def update(self, matrix):
+        """ Collect statistics from a block of feature vectors """
+
+        self.count += matrix.shape[0]
+        self.weights = None
+        if self.scheme == "idf":
+            dims = matrix.indices[matrix.data != 0]
+            self.df += np.bincount(dims, minlength=len(self.df))
+        elif self.scheme == "maxabs" and matrix.nnz > 0:
+            absmax = abs(matrix).max(axis=0).toarray().ravel()
+            self.maxabs = np.maximum(self.maxabs, absmax)
+
+    def transform(self, matrix):
+        """ Apply weighting to a block of feature vectors (in place) """
+
+        if self.weights is None:
+            if self.scheme == "idf":
+                idf = np.log((1.0 + self.count) / (1.0 + self.df)) + 1.0
+                self.weights = idf
+            elif self.scheme == "maxabs":
+                scale = self.maxabs.copy()
+                scale[scale == 0] = 1.0
+                self.weights = 1.0 / scale
+            else:
+                self.weights = np.ones(len(self.df))
+
+        matrix.data *= self.weights[matrix.indices]
+        return matrix
+
+
+def graph_to_fvec(graph, mode=0, conf=None, norm=True):
+    """ Map graph to (normalized) feature vector """
+
+    bag = globals()[modes[mode]](graph, conf)
+    fvec, _ = bag_to_fvec(bag, conf)
+    return fvec_norm(fvec, conf) if norm else fvec
+
+
+class BagState(object):
+    """ Bag of subgraphs of an evolving graph. The bag is kept as the sum
+        of the contributions of each node together with its hashed
+        vector. A change of the graph only requires recomputing the
+        contributions of nodes that reach it within the radius of the
+        mode. Modes 0 to 4 are supported without sampling of sources.
+        The graph is modified in place. """
+
+    def __init__(self, graph, mode=0, conf=None):
+        conf = conf or args
+        if mode not in [0, 1, 2, 3, 4]:
+            raise Exception("Incremental bag mode %d not supported" % mode)
+        if mode in [3, 4] and conf.sample > 0:
+            raise Exception("Incremental bags do not support sampling")
+        if mode == 1 and not graph.is_directed():
+            raise Exception("Incremental bag of edges needs directed graph")
+
+        self.graph = graph
+        self.mode = mode
+        self.conf = conf
+        self.radius = [0, 1, conf.size, conf.depth, conf.maxlen][mode]
+        self.bag = {}
+        self.hashed = {}
+        self.contribs = {}
+
+        for x in graph.nodes():
+            self.contribs[x] = self.contribution(x)
+            self.apply(self.contribs[x], 1)
+
+    def contribution(self, x):
+        """ Compute bag of subgraphs contributed by node x """
+
+        graph, conf = self.graph, self.conf
+        label = lambda y: node_label(graph.node[y], conf)
+        bag = {}
+
+        if self.mode == 0:
+            bag[label(x)] = 1
+        elif self.mode == 1:
+            for _, y in graph.edges(x):
+                key = "%s-%s" % (label(x), label(y))
+                bag[key] = bag.get(key, 0) + 1
+        elif self.mode in [2, 3]:
+            # Sources do not reach themselves, as in the full bags
+            reach = nx.single_source_shortest_path_length(graph, x,
+                                                          self.radius)
+            ns = sorted(label(y) for y in reach if y != x)
+            if self.mode == 2:
+                bag["%s:%s" % (label(x), '-'.join(ns))] = 1.0
+            else:
+                for n in ns:
+                    key = "%s:%s" % (label(x), n)
+                    bag[key] = bag.get(key, 0.0) + 1.0
+        else:
+            paths = nx.single_source_shortest_path(graph, x, self.radius)
+            for path in paths.values():
+                if len(path) - 1 < conf.minlen:
+                    continue
+                key = '-'.join(map(label, path))
+                bag[key] = bag.get(key, 0.0) + 1.0
+
+        return bag
+
+    def apply(self, bag, sign):
+        """ Add or subtract bag from the bag and the hashed vector """
+
+        for key, count in bag.items():
+            value = self.bag.get(key, 0) + sign * count
+            if value == 0:
+                self.bag.pop(key, None)
+            else:
+                self.bag[key] = value
+
+            hash = utils.murmur3(key)
+            dim = (hash & (1 << self.conf.bits) - 1) + 1
+            value = self.hashed.get(dim, 0) + \
+                sign * (2 * (hash >> 31) - 1) * count
+            if value == 0:
+                self.hashed.pop(dim, None)
+            else:
+                self.hashed[dim] = value
+
+    def sources(self, nodes, cutoff):
+        """ Return nodes reaching any of the given nodes within cutoff """
+
+        graph = self.graph
+        pred = graph.predecessors if graph.is_directed() else graph.neighbors
+        if cutoff < 0:
+            return set()
+
+        found = set(x for x in nodes if x in graph)
+        frontier = list(found)
+        for _ in range(cutoff):
+            reached = []
+            for x in frontier:
+                for y in pred(x):
+                    if y not in found:
+                        found.add(y)
+                        reached.append(y)
+            frontier = reached
+
+        return found
+
+    def affected(self, nodes, tails):
+        """ Return nodes whose contribution depends on the given nodes or
+            on edges starting at the given tails """
+        return self.sources(nodes, self.radius) | \
+            self.sources(tails, self.radius - 1)
+
+    def update(self, add_nodes=None, remove_nodes=None, add_edges=None,
+               remove_edges=None, labels=None):
+        """ Update graph and bag. Added nodes and changed labels are given
+            as dicts of nodes and attributes, edges as lists of pairs.
+            Edges of removed nodes are removed as well. Returns the set
+            of nodes whose contribution has been recomputed. """
+
+        graph = self.graph
+        add_nodes = add_nodes or {}
+        remove_nodes = set(remove_nodes or [])
+        add_edges = list(add_edges or [])
+        remove_edges = list(remove_edges or [])
+        labels = labels or {}
+
+        for x in remove_nodes | set(labels):
+            if x not in graph:
+                raise Exception("Unknown node '%s'" % x)
+        for i, j in remove_edges:
+            if not graph.has_edge(i, j):
+                raise Exception("Unknown edge '%s-%s'" % (i, j))
+
+        # Nodes reaching removed nodes are covered by their radius.
+        # Undirected edges start at both of their nodes.
+        nodes = set(labels) | remove_nodes | set(add_nodes)
+        tails = set(i for i, _ in add_edges + remove_edges)
+        if not graph.is_directed():
+            tails.update(j for _, j in add_edges + remove_edges)
+
+        # Contributions depending on the change before and after it
+        affected = self.affected(nodes, tails)
+        graph.remove_edges_from(remove_edges)
+        graph.remove_nodes_from(remove_nodes)
+        for x, attr in add_nodes.items():
+            graph.add_node(x, attr)
+        for x, attr in labels.items():
+            graph.node[x].update(attr)
+        graph.add_edges_from(add_edges)
+        affected |= self.affected(nodes, tails)
+
+        # Edges may add nodes without attributes
+        for edge in add_edges:
+            affected.update(x for x in edge if x not in self.contribs)
+
+        for x in affected:
+            if x in self.contribs:
+                self.apply(self.contribs.pop(x), -1)
+            if x in graph:
+                self.contribs[x] = self.contribution(x)
+                self.apply(self.contribs[x], 1)
+
+        return affected
+
+    def fvec(self):
+        """ Return hashed feature vector of the bag """
+        return utils.SparseVector.from_dict(self.hashed)
+
+
+class Hasher(object):
+    """ Feature hashing of graphs with a fixed configuration """
+
+    def __init__(self, mode=0, processes=None, **kwargs):
+        """ Create hasher for a mode. Further keyword arguments override
+            the defaults of the command-line arguments, e.g. bits=16 """
+
+        parser = argparse.ArgumentParser()
+        add_arguments(parser)
+        self.args = parser.parse_args([])
+
+        for key, value in kwargs.items():
+            if not hasattr(self.args, key):
+                raise Exception("Unknown setting '%s'" % key)
+            setattr(self.args, key, value)
+
+        if mode not in modes:
+            raise Exception("Unknown bag mode %d" % mode)
+
+        self.mode = mode
+        self.processes = processes
+        self.pool = None
+        self.weighting = None
+
+    @classmethod
+    def from_args(cls, pargs, mode=None, processes=None):
+        """ Create hasher from parsed command-line arguments """
+
+        hasher = cls(mode if mode is not None else pargs.mode, processes)
+        hasher.args = copy.copy(pargs)
+        return hasher
+
+    @classmethod
+    def from_settings(cls, settings, processes=None):
+        """ Create hasher from a dict of settings, e.g. loaded from json """
+
+        settings = {str(k): str(v) if isinstance(v, unicode) else v
+                    for k, v in settings.items()}
+        mode = settings.pop("mode")
+        return cls(mode, processes, **settings)
+
+    def settings(self):
+        """ Return mode and configuration of the hasher as a dict """
+
+        parser = argparse.ArgumentParser()
+        add_arguments(parser)
+        settings = {k: getattr(self.args, k)
+                    for k in vars(parser.parse_args([]))}
+        settings["mode"] = self.mode
+        return settings
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def start(self):
+        """ Start the worker pool """
+
+        if self.processes != 0 and not self.pool:
+            self.pool = Pool(self.processes)
+
+    def close(self):
+        """ Shut down the worker pool """
+
+        if self.pool:
+            self.pool.close()
+            self.pool.join()
+            self.pool = None
+
+    def name(self):
+        """ Return the name and config of the bag mode """
+        return bag_name(self.mode, self.args)
+
+    def dim(self):
+        """ Return the number of dimensions of the vector space """
+        return (1 << self.args.bits) + 1
+
+    def map(self, func, items):
+        """ Map function over items using the persistent worker pool """
+
+        if self.processes == 0 or len(items) < 2:
+            return list(map(func, items))
+        self.start()
+        return self.pool.map(func, items)
+
+    def imap(self, func, items, chunksize=1):
+        """ Lazily map function over items using the worker pool """
+
+        if self.processes == 0:
+            return itertools.imap(func, items)
+        self.start()
+        return self.pool.imap(func, items, chunksize)
+
+    def bag(self, graph):
+        """ Build bag of subgraphs for graph """
+        return globals()[modes[self.mode]](graph, self.args)
+
+    def state(self, graph):
+        """ Create bag state for incremental updates of graph """
+        return BagState(graph, self.mode, self.args)
+
+    def bags(self, graphs):
+        """ Build bags of subgraphs for graphs """
+        func = partial(globals()[modes[self.mode]], conf=self.args)
+        return self.map(func, graphs)
+
+    def hash(self, bags):
+        """ Map bags to feature vectors and feature maps """
+        items = self.map(partial(bag_to_fvec, conf=self.args), bags)
+        return [list(x) for x in zip(*items)] if items else ([], [])
+
+    def norm(self, fvecs):
+        """ Normalize feature vectors """
+        return self.map(partial(fvec_norm, conf=self.args), fvecs)
+
+    def transform(self, graph):
+        """ Map graph to normalized feature vector. The corpus weighting
+            is applied as in transform_many. """
+
+        if self.args.weight.lower() != "none":
+            matrix = self.transform_many([graph])
+            return utils.SparseVector.from_dict(utils.csr_to_fvecs(matrix)[0])
+        return graph_to_fvec(graph, self.mode, self.args)
+
+    def transform_many(self, graphs, fit=False):
+        """ Map graphs to normalized feature vectors in a sparse matrix.
+            If fit is true, the graphs are added to the statistics of
+            the corpus weighting before it is applied. """
+
+        func = partial(graph_to_fvec, mode=self.mode, conf=self.args,
+                       norm=False)
+        fvecs = self.map(func, list(graphs))
+        matrix = matrix_map(utils.fvecs_to_csr(fvecs, self.dim()), self.args)
+
+        if self.args.weight.lower() != "none":
+            if not self.weighting:
+                self.weighting = Weighting(self.args.weight, self.dim())
+            if fit:
+                self.weighting.update(matrix)
+            if self.weighting.count == 0:
+                raise Exception("No statistics for weighting available")
+            matrix = self.weighting.transform(matrix)
+
+        return matrix_norm(matrix, self.args)
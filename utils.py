@@ -1,18 +1,22 @@
 # Siggi - Feature Hashing for Labeled Graph
 # (c) 2015-2016 Konrad Rieck (konrad@mlsec.org)
 
+import bisect
 import json
 import os
 import re
 import math
 import tempfile
 import zipfile as zf
-from io import StringIO
+from array import array
+from io import StringIO, BytesIO
 from functools import partial
 from multiprocessing import Pool
 
 import networkx as nx
+import numpy as np
 import pygraphviz as pg
+import scipy.sparse as sp
 
 
 def chunkify_entries(entries, num):
@@ -64,23 +68,49 @@ def load_bundle_entry(archive_entry , regex):
     """ Load one graph from zip archive """
     archive, entry = archive_entry
 
-    # Determine label
+    label = entry_label(entry, regex)
+
+    # Determine format and load graph
+    format = entry_format(entry)
+    if format:
+        graph = parse_graph(archive.open(entry).read(), format)
+    else:
+        graph = None
+
+    return graph, label
+
+
+def entry_label(entry, regex):
+    """ Determine label of a zip entry from its filename """
+
     match = regex.match(os.path.basename(entry))
     if match and len(match.group(0)) > 0:
-        label = int(match.group(0))
-    else:
-        label = 0
+        return int(match.group(0))
+    return 0
+
+
+def entry_format(entry):
+    """ Determine graph format of a zip entry from its suffix """
 
-    # Determine format and load graph
     if entry.endswith(".dot"):
-        graph = pg.AGraph(archive.open(entry).read())
-        graph = nx.drawing.nx_agraph.from_agraph(graph)
+        return "dot"
     elif entry.endswith(".graphml"):
-        graph = nx.read_graphml(archive.open(entry))
+        return "graphml"
+    return None
+
+
+def parse_graph(data, format="dot"):
+    """ Parse one graph from a string in dot or graphml format """
+
+    if format == "dot":
+        graph = pg.AGraph(data)
+        graph = nx.drawing.nx_agraph.from_agraph(graph)
+    elif format == "graphml":
+        graph = nx.read_graphml(BytesIO(data))
     else:
-        graph = None
+        raise Exception("Unknown format %s" % format)
 
-    return graph, label
+    return graph
 
 
 def save_bundle(filename, graphs, format="dot", label=0):
@@ -124,16 +154,24 @@ def save_libsvm(filename, fvecs, labels, append=False):
         f = open(filename, "a")
 
     for fvec, label in zip(fvecs, labels):
-        f.write("%d" % label)
-        for dim in sorted(fvec):
-            if abs(fvec[dim]) < 1e-9:
-                continue
-            f.write(" %d:%g" % (dim, fvec[dim]))
+        f.write(format_libsvm(fvec, label))
         f.write("\n")
 
     f.close()
 
 
+def format_libsvm(fvec, label=0):
+    """ Format one feature vector as libsvm line """
+
+    line = ["%d" % label]
+    for dim, val in sorted(fvec.items()):
+        if abs(val) < 1e-9:
+            continue
+        line.append("%d:%g" % (dim, val))
+
+    return " ".join(line)
+
+
 def load_libsvm(filename):
     """ Load feature vectors from libsvm file """
 
@@ -155,6 +193,160 @@ def load_libsvm(filename):
     return fvecs, labels
 
 
+class SparseVector(object):
+    """ Compact sparse feature vector. Dimensions are stored sorted in an
+        array together with their values. The vector behaves like a
+        read-mostly dict and pickles as two raw byte strings. """
+
+    __slots__ = ("dims", "vals")
+
+    def __init__(self, dims=(), vals=()):
+        """ Create vector from sorted dimensions and values """
+        self.dims = array("l", dims)
+        self.vals = array("d", vals)
+
+    @classmethod
+    def from_dict(cls, fvec):
+        """ Create vector from dict of dimensions and values """
+
+        items = sorted(fvec.items())
+        return cls((d for d, _ in items), (v for _, v in items))
+
+    def __getstate__(self):
+        return self.dims.tostring(), self.vals.tostring()
+
+    def __setstate__(self, state):
+        self.dims = array("l")
+        self.vals = array("d")
+        self.dims.fromstring(state[0])
+        self.vals.fromstring(state[1])
+
+    def __len__(self):
+        return len(self.dims)
+
+    def __iter__(self):
+        return iter(self.dims)
+
+    def __contains__(self, dim):
+        i = bisect.bisect_left(self.dims, dim)
+        return i < len(self.dims) and self.dims[i] == dim
+
+    def __getitem__(self, dim):
+        i = bisect.bisect_left(self.dims, dim)
+        if i == len(self.dims) or self.dims[i] != dim:
+            raise KeyError(dim)
+        return self.vals[i]
+
+    def __setitem__(self, dim, val):
+        i = bisect.bisect_left(self.dims, dim)
+        if i == len(self.dims) or self.dims[i] != dim:
+            self.dims.insert(i, dim)
+            self.vals.insert(i, val)
+        else:
+            self.vals[i] = val
+
+    def __eq__(self, other):
+        return dict(self.items()) == dict(other.items())
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return "SparseVector(%r)" % dict(self.items())
+
+    def keys(self):
+        return self.dims.tolist()
+
+    def values(self):
+        return self.vals.tolist()
+
+    def items(self):
+        return zip(self.dims, self.vals)
+
+    def get(self, dim, default=None):
+        return self[dim] if dim in self else default
+
+
+def fvecs_to_csr(fvecs, dim=None):
+    """ Convert feature vectors to sparse matrix in CSR format """
+
+    indptr = [0]
+    indices, data = [], []
+    for fvec in fvecs:
+        if isinstance(fvec, SparseVector):
+            indices.extend(fvec.dims)
+            data.extend(fvec.vals)
+        else:
+            for d, val in sorted(fvec.items()):
+                indices.append(d)
+                data.append(val)
+        indptr.append(len(indices))
+
+    if dim is None:
+        dim = max(indices) + 1 if indices else 1
+
+    return sp.csr_matrix((
+        np.array(data, dtype=np.float64),
+        np.array(indices, dtype=np.int64),
+        np.array(indptr, dtype=np.int64)
+    ), shape=(len(fvecs), dim))
+
+
+def csr_to_fvecs(matrix):
+    """ Convert sparse matrix in CSR format to feature vectors """
+
+    fvecs = []
+    for i in range(matrix.shape[0]):
+        row = slice(matrix.indptr[i], matrix.indptr[i + 1])
+        fvecs.append(dict(zip(
+            matrix.indices[row].tolist(), matrix.data[row].tolist()
+        )))
+
+    return fvecs
+
+
+def write_libsvm_csr(f, matrix, labels, fmt="%g"):
+    """ Write sparse matrix in CSR format to open libsvm file """
+
+    for i, label in enumerate(labels):
+        row = slice(matrix.indptr[i], matrix.indptr[i + 1])
+        dims = matrix.indices[row].tolist()
+        vals = matrix.data[row].tolist()
+
+        line = ["%d" % label]
+        for dim, val in zip(dims, vals):
+            if abs(val) < 1e-9:
+                continue
+            line.append(("%d:" + fmt) % (dim, val))
+        f.write(" ".join(line))
+        f.write("\n")
+
+
+def iter_libsvm(filename, block=1024, dim=None):
+    """ Load feature vectors from libsvm file in blocks of CSR matrices """
+
+    fvecs, labels = [], []
+
+    with open(filename, "rt") as f:
+        for line in f:
+            if line.startswith("#") or len(line.strip()) == 0:
+                continue
+            tokens = line.strip().split()
+            labels.append(int(tokens[0]))
+
+            fv = {}
+            for token in tokens[1:]:
+                d, _, val = token.partition(':')
+                fv[int(d)] = float(val)
+            fvecs.append(fv)
+
+            if len(fvecs) == block:
+                yield fvecs_to_csr(fvecs, dim), labels
+                fvecs, labels = [], []
+
+    if fvecs:
+        yield fvecs_to_csr(fvecs, dim), labels
+
 
 def stack_fvecs(fvecs1, fvecs2):
     """ Stack two feature spaces """
@@ -168,10 +360,12 @@ def stack_fvecs(fvecs1, fvecs2):
     nfv = []
     for fv1, fv2 in zip(fvecs1, fvecs2):
         fv = {}
-        for dim in fv1:
-            fv[dim] = fv1[dim]
-        for dim in fv2:
-            fv[dim | offset] = fv2[dim]
+        for dim, val in fv1.items():
+            fv[dim] = val
+        for dim, val in fv2.items():
+            fv[dim | offset] = val
+        if isinstance(fv1, SparseVector):
+            fv = SparseVector.from_dict(fv)
         nfv.append(fv)
 
     return nfv
@@ -195,6 +389,38 @@ def save_fmap(filename, fmaps):
     json.dump(final, open(filename, "w"))
 
 
+def settings_file(filename):
+    """ Return name of the settings file stored next to a libsvm file """
+    return filename + ".settings"
+
+
+def save_settings(filename, settings):
+    """ Save settings of a libsvm file in json format """
+
+    with open(settings_file(filename), "w") as f:
+        json.dump(settings, f, indent=2, sort_keys=True)
+
+
+def load_settings(filename):
+    """ Load settings of a libsvm file. Returns None if not present. """
+
+    if not os.path.exists(settings_file(filename)):
+        return None
+    with open(settings_file(filename)) as f:
+        return json.load(f)
+
+
+def parse_size(string):
+    """ Parse size in bytes with optional suffix K, M, G or T """
+
+    match = re.match(r"^\s*(\d+(?:\.\d*)?)\s*([kmgt]?)b?\s*$", string, re.I)
+    if not match:
+        raise Exception("Invalid size '%s'" % string)
+
+    value, unit = match.groups()
+    return int(float(value) * 1024 ** " kmgt".index(unit.lower() or " "))
+
+
 def murmur3(data, seed=0):
     """ Implementation of Murmur 3 hash by Maurus Decimus """
 